@@ -6,11 +6,25 @@ import time
 import threading
 import json
 import os
+import multiprocessing
+import queue
+import struct
+from concurrent.futures import ProcessPoolExecutor
 from bluezero import peripheral
 import cv2
 import numpy as np
 from motor_module import MotorModule
 from collections import namedtuple
+import msgspec
+
+# Commands and responses travel as msgpack bodies behind a 4-byte length
+_encoder = msgspec.msgpack.Encoder()
+_decoder = msgspec.msgpack.Decoder()
+
+try:
+    from numba import njit
+except ImportError:  # optional; scan_windows falls back to NumPy
+    njit = None
 
 # Brightness Level Detection Setup 
 BLevel = namedtuple("BLevel", ['brange', 'bval'])
@@ -28,28 +42,72 @@ _blevels = [
     BLevel(brange=range(231, 256), bval=10),
 ]
 
+# Lookup table from brightness value to level. Filled in reverse so that
+# values shared by two neighbouring ranges keep the lower level.
+_LUT = np.empty(256, np.uint8)
+for _bl in reversed(_blevels):
+    _LUT[list(_bl.brange)] = _bl.bval
+
 def detect_level(h_val):
     h_val = int(h_val)
-    for blevel in _blevels:
-        if h_val in blevel.brange:
-            return blevel.bval
-    raise ValueError("Brightness Level Out of Range")
+    if not 0 <= h_val < len(_LUT):
+        raise ValueError("Brightness Level Out of Range")
+    return int(_LUT[h_val])
 
 def get_img_avg_brightness(img):
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-    _, _, v = cv2.split(hsv)
-    return int(np.average(v.flatten()))
+    # HSV value is the per-pixel channel maximum
+    return int(img.max(axis=2).mean())
+
+WINDOW = 10
+
+def _scan_rows(row_sums, threshold):
+    # Loop form of the scan in scan_windows, only used when numba compiles it
+    n = row_sums.shape[0]
+    prev = 0
+    for r in range(min(WINDOW, n)):
+        prev += row_sums[r]
+    i = WINDOW
+    while i + WINDOW < n:
+        cur = 0
+        for r in range(i, i + WINDOW):
+            cur += row_sums[r]
+        if prev - cur > threshold:
+            return 1
+        prev = cur
+        i += 2
+    return 0
+
+if njit is not None:
+    _scan_rows = njit(cache=True)(_scan_rows)
+
+def scan_windows(part, threshold):
+    # Sum of every WINDOW-row block via a cumulative sum over the rows.
+    # The first block (row 0) is compared with the one at row WINDOW, then
+    # each block with the next one two rows further down; returns 1 as soon
+    # as the drop between two compared blocks exceeds the threshold.
+    # int32 is enough: a whole 140x140x3 crop sums to under 2**24
+    row_sums = part.sum(axis=(1, 2), dtype=np.int32)
+    if njit is not None:
+        return _scan_rows(row_sums, threshold)
+    cs = np.concatenate((np.zeros(1, np.int32), np.cumsum(row_sums, dtype=np.int32)))
+    win = cs[WINDOW:] - cs[:-WINDOW]
+    starts = np.arange(WINDOW, len(part) - WINDOW, 2)
+    if not starts.size:
+        return 0
+    prev = np.concatenate(([0], starts[:-1]))
+    return 1 if np.any(win[prev] - win[starts] > threshold) else 0
 
 def process(img_path):
     c = 1
     l = []
     b_val = []
     n = 0
+    # Only channel-order independent values (V and pixel sums) are used
+    # below, so the BGR image from imread is sliced as is.
+    bb = cv2.imread(img_path)
+    prt_1 = bb[:, :400]
+    prt_2 = bb[:, 400:]
     while c < 3:
-        bb = cv2.imread(img_path)
-        bb_1 = cv2.cvtColor(bb, cv2.COLOR_RGB2BGR)
-        prt_1 = bb_1[:, :400]
-        prt_2 = bb_1[:, 400:]
         if c == 1:
             check_img = prt_1[0:100, 100:200]
             b_value = detect_level(get_img_avg_brightness(check_img))
@@ -79,30 +137,8 @@ def process(img_path):
                 prt_11 = prt_2[:300, 100:230]
         prt_11_1 = prt_11[:140]
         prt_11_2 = prt_11[140:280]
-        i = 10
-        ini_sum = np.sum(prt_11_1[0:10])
-        count_t = 0
-        while i + 10 < len(prt_11_1):
-            m = np.sum(prt_11_1[i:i + 10])
-            s_t = np.subtract(ini_sum.astype(np.int64), m.astype(np.int64))
-            if s_t > 1000:
-                count_t += 1
-                break
-            else:
-                ini_sum = np.sum(prt_11_1[i:i + 10])
-                i += 2
-        i = 10
-        ini_sum = np.sum(prt_11_2[0:10])
-        count_c = 0
-        while i + 10 < len(prt_11_2):
-            m = np.sum(prt_11_2[i:i + 10])
-            s_c = np.subtract(ini_sum.astype(np.int64), m.astype(np.int64))
-            if s_c > -1000:
-                count_c += 1
-                break
-            else:
-                ini_sum = np.sum(prt_11_2[i:i + 10])
-                i += 2
+        count_t = scan_windows(prt_11_1, 1000)
+        count_c = scan_windows(prt_11_2, -1000)
         if count_c == 1 and count_t == 0:
             cnt = 1
         elif count_c == 1 and count_t == 1:
@@ -117,21 +153,43 @@ def process(img_path):
             l = [1, cnt, 2, 0]
     return l
 
+# Worker processes for process(); created once so the BLE callback thread
+# only submits work. They are forked explicitly and started right here, before
+# the motor, the BLE peripheral and the writer thread exist: with spawn or
+# forkserver (the Linux default from Python 3.14) every worker would re-import
+# this script and re-run clear_image_folder() and the hardware setup, and a
+# fork at first use would copy an already multithreaded GLib process.
+POOL_WORKERS = 4
+_fork = multiprocessing.get_context("fork")
+# Inherited by every worker at fork; one task per worker blocks on it until all
+# of them run, so each warm-up task forks its own worker even on Python
+# 3.9/3.10, where a pool forks workers one submit at a time
+_workers_started = _fork.Barrier(POOL_WORKERS)
+
+def _wait_for_all_workers():
+    _workers_started.wait(timeout=30)
+
+_pool = ProcessPoolExecutor(max_workers=POOL_WORKERS, mp_context=_fork)
+for _warmup in [_pool.submit(_wait_for_all_workers) for _ in range(POOL_WORKERS)]:
+    _warmup.result()
+
 
 # === BLE and Networking Setup ===
 motor = MotorModule()
 
 folder_path = '/home/rpiez/received_images'
+IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png'})
 def clear_image_folder(folder_path=folder_path):
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
-    for filename in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, filename)
-        if os.path.isfile(file_path):
-            os.remove(file_path)
+    with os.scandir(folder_path) as it:
+        for entry in it:
+            if entry.is_file():
+                os.remove(entry.path)
 clear_image_folder()
 
 ADAPTER_ADDR = 'B8:27:EB:11:A5:AA'
+MOTOR_SETTLE_TIME = 2
 my_device = peripheral.Peripheral(adapter_address=ADAPTER_ADDR, local_name='master')
 result = "master Ready"
 processing_complete = False
@@ -142,13 +200,18 @@ def write_callback(value, options):
     print(f"Received command: {command}")
     if command.strip() == "capture":
         processing_complete = False
-        motor.rotate_anticlockwise()
-        time.sleep(2)
-        threading.Thread(target=send_capture_to_all_slaves).start()
+        threading.Thread(target=rotate_and_capture).start()
     if command.strip() == "cw":
         print("Received command to rotate clockwise")
         motor.rotate_clockwise()
 
+def rotate_and_capture():
+    motor.rotate_anticlockwise()
+    # MotorModule has no completion signal, so the platform gets a fixed
+    # settle time; it runs here rather than on the BLE callback thread
+    time.sleep(MOTOR_SETTLE_TIME)
+    send_capture_to_all_slaves()
+
 def read_callback(options):
     global result
     return result.encode('utf-8')
@@ -162,35 +225,65 @@ SLAVE_HOSTS = {
 }
 SLAVE_PORT = 8888
 TIMEOUT = 30
+CHUNK_SIZE = 65536
+RECV_BUFFER_SIZE = 1 << 20
+FRAME_HEADER = struct.Struct('>I')  # Big-endian length in front of every command and response
 MASTER_IMAGE_DIR = folder_path
 os.makedirs(MASTER_IMAGE_DIR, exist_ok=True)
 
+# Capture command encoded once per send_image value; each send patches in the
+# timestamp, which msgpack stores as a fixed-width big-endian float64
+def _capture_command_template(send_image):
+    body = _encoder.encode({"action": "capture", "timestamp": 0.0, "send_image": send_image})
+    return FRAME_HEADER.pack(len(body)) + body
+
+CAPTURE_COMMANDS = {send_image: _capture_command_template(send_image) for send_image in (True, False)}
+TIMESTAMP = struct.Struct('>d')
+TIMESTAMP_OFFSET = CAPTURE_COMMANDS[True].index(b"\xa9timestamp\xcb") + len(b"\xa9timestamp\xcb")
+
+def capture_command(send_image):
+    command = bytearray(CAPTURE_COMMANDS[bool(send_image)])
+    TIMESTAMP.pack_into(command, TIMESTAMP_OFFSET, time.time())
+    return command
+
+# Characteristic updates are pushed from a dedicated thread so callers,
+# including the BLE write callback, never block on the GATT notify
+_ble_q = queue.Queue()
+
+def _ble_writer():
+    while True:
+        value = _ble_q.get()
+        try:
+            my_device.update_characteristic_value(1, 2, value.encode('utf-8'))
+            print(f"BLE characteristic updated with result: {value}")
+        except Exception as e:
+            print(f"Error updating BLE characteristic: {e}")
+
+threading.Thread(target=_ble_writer, daemon=True).start()
+
 def update_ble_result(new_result):
     global result, processing_complete
     result = new_result
     processing_complete = True
-    try:
-        my_device.update_characteristic_value(1, 2, result.encode('utf-8'))
-        print(f"BLE characteristic updated with result: {result}")
-    except Exception as e:
-        print(f"Error updating BLE characteristic: {e}")
+    _ble_q.put(new_result)
 
 def process_image_data(device=None, folder_path=folder_path):
     process_results = []
     try:
-        image_files = [f for f in os.listdir(folder_path) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+        with os.scandir(folder_path) as it:
+            image_files = [entry for entry in it
+                           if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS]
         if not image_files:
             update_ble_result("No images to process")
             return []
-        for filename in image_files:
-            file_path = os.path.join(folder_path, filename)
-            if os.path.isfile(file_path):
-                try:
-                    result = process(file_path)
-                    process_results.append(result)
-                    print(f"Processed {filename}: {result}")
-                except Exception as e:
-                    print(f"Error processing {filename}: {e}")
+        futures = [(entry.name, _pool.submit(process, entry.path)) for entry in image_files]
+        for name, future in futures:
+            try:
+                result = future.result()
+                process_results.append(result)
+                print(f"Processed {name}: {result}")
+            except Exception as e:
+                print(f"Error processing {name}: {e}")
         if process_results:
             update_ble_result(json.dumps({"results": process_results, "status": "complete"}))
         else:
@@ -202,58 +295,114 @@ def process_image_data(device=None, folder_path=folder_path):
     return process_results
 
 # === TCP Communication ===
+def recv_exactly(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise ConnectionError("Connection closed by slave")
+        received += n
+    return buf
+
+def recv_response(sock):
+    # Responses are framed by their length, so a segmented response is never parsed half-read
+    (size,) = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+    return _decoder.decode(recv_exactly(sock, size))
+
 def receive_image_from_slave(sock, slave_id, response_data):
     try:
-        size_data = sock.recv(1024).decode().strip()
-        file_size = int(size_data)
-        sock.send("READY".encode())
-        received_data = b""
+        # The image follows the capture response, which carries its size
+        file_size = int(response_data['file_size'])
+        received_data = bytearray(file_size)
+        view = memoryview(received_data)
         bytes_received = 0
         while bytes_received < file_size:
-            chunk = sock.recv(min(4096, file_size - bytes_received))
-            if not chunk:
+            n = sock.recv_into(view[bytes_received:bytes_received + min(CHUNK_SIZE, file_size - bytes_received)])
+            if not n:
                 break
-            received_data += chunk
-            bytes_received += len(chunk)
+            bytes_received += n
         if bytes_received == file_size:
             timestamp = int(time.time())
             filename = f"master_received_slave{slave_id}_{timestamp}.jpg"
             filepath = os.path.join(MASTER_IMAGE_DIR, filename)
             with open(filepath, 'wb') as f:
                 f.write(received_data)
-            time.sleep(1)
             return {"success": True, "filepath": filepath, "filename": filename, "size": file_size}
         else:
             return {"success": False, "error": "Incomplete transfer"}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
-def send_capture_command(slave_host, slave_id, receive_image=True):
+# One long-lived connection per slave, reused across captures
+_slave_conns = {}
+_slave_locks = {slave_id: threading.Lock() for slave_id in SLAVE_HOSTS}
+
+def _connect(slave_host):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+    sock.settimeout(TIMEOUT)
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(TIMEOUT)
         sock.connect((slave_host, SLAVE_PORT))
-        command = {
-            "action": "capture",
-            "timestamp": time.time(),
-            "send_image": receive_image
-        }
-        sock.send((json.dumps(command) + '\n').encode())
-        response = sock.recv(1024).decode().strip()
-        response_data = json.loads(response)
-        if response_data['status'] == 'success':
-            if receive_image:
-                return receive_image_from_slave(sock, slave_id, response_data)
-            else:
-                return {"success": True, "message": "Command sent, no image requested"}
-        else:
-            return {"success": False, "error": response_data.get('error', 'Unknown error')}
-    except Exception as e:
-        return {"success": False, "error": str(e)}
-    finally:
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+def drop_slave_connection(slave_id):
+    sock = _slave_conns.pop(slave_id, None)
+    if sock is not None:
         try: sock.close()
         except: pass
 
+def connect_all_slaves():
+    for slave_id, slave_host in SLAVE_HOSTS.items():
+        try:
+            _slave_conns[slave_id] = _connect(slave_host)
+        except Exception as e:
+            print(f"[MASTER] Slave {slave_id} not reachable yet: {e}")
+
+def request_capture(slave_host, slave_id, command):
+    # A reused connection may have been closed by the slave since the last
+    # capture; in that case reconnect once and resend
+    for attempt in range(2):
+        reused = slave_id in _slave_conns
+        if not reused:
+            _slave_conns[slave_id] = _connect(slave_host)
+        sock = _slave_conns[slave_id]
+        try:
+            sock.sendall(command)
+            return sock, recv_response(sock)
+        except socket.timeout:
+            # The slave may still be capturing; resending would queue a second capture
+            drop_slave_connection(slave_id)
+            raise
+        except OSError:
+            drop_slave_connection(slave_id)
+            if not reused or attempt:
+                raise
+
+def send_capture_command(slave_host, slave_id, receive_image=True):
+    with _slave_locks[slave_id]:
+        try:
+            command = capture_command(receive_image)
+            sock, response_data = request_capture(slave_host, slave_id, command)
+            if response_data['status'] == 'success':
+                if receive_image:
+                    image_result = receive_image_from_slave(sock, slave_id, response_data)
+                    if not image_result['success']:
+                        drop_slave_connection(slave_id)
+                    return image_result
+                else:
+                    return {"success": True, "message": "Command sent, no image requested"}
+            else:
+                return {"success": False, "error": response_data.get('error', 'Unknown error')}
+        except Exception as e:
+            drop_slave_connection(slave_id)
+            return {"success": False, "error": str(e)}
+
 def send_capture_to_all_slaves(receive_images=True):
     threads = []
     results = {}
@@ -270,7 +419,6 @@ def send_capture_to_all_slaves(receive_images=True):
     successful_transfers = [r for r in results.values() if r.get('success', False)]
     if successful_transfers:
         update_ble_result("Images received, processing...")
-        time.sleep(1)
         process_image_data(device=my_device, folder_path=MASTER_IMAGE_DIR)
     else:
         update_ble_result("No images received")
@@ -279,6 +427,7 @@ def send_capture_to_all_slaves(receive_images=True):
 if __name__ == "__main__":
     print("[MASTER] Starting BLE WiFi Camera Controller")
     print(f"[MASTER] Using Bluetooth adapter: {ADAPTER_ADDR}")
+    connect_all_slaves()
     my_device.add_service(srv_id=1, uuid='12345678-1234-5678-1234-56789abcdef0', primary=True)
     my_device.add_characteristic(
         srv_id=1, chr_id=1,
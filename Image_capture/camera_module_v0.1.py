@@ -3,6 +3,7 @@
 #=============================
 
 import time
+from pathlib import Path
 from picamera2 import Picamera2
 import numpy as np
 import imageio
@@ -41,9 +42,8 @@ class CameraModule:
         self.camera.start()
         
         try:
-            preview = self.camera.capture_file("preview.jpg")
-            preview = cv2.imread("preview.jpg")
-            avg_brightness = np.mean(preview)
+            preview = self.camera.capture_array()
+            avg_brightness = float(preview.mean())
             print(f"Initial average brightness: {avg_brightness}")
             
             # Get current auto exposure settings
@@ -96,8 +96,8 @@ class CameraModule:
                 # Convert to float for processing
                 image_float = image.astype(np.float32) / 255.0
                 
-                # Calculate the average color of the image
-                avg_color = np.mean(image_float, axis=(0, 1))
+                # Calculate the average color of the image (single-pass per-channel mean)
+                avg_color = np.array(cv2.mean(image)[:3]) / 255.0
                 print(f"Average color channels before correction: R={avg_color[0]:.3f}, G={avg_color[1]:.3f}, B={avg_color[2]:.3f}")
                 
                 # Calculate scaling factors to balance the image colors
@@ -110,16 +110,14 @@ class CameraModule:
                 corrected_image = corrected_image.astype(np.uint8)
                 
                 # Verify color correction effect
-                avg_color_after = np.mean(corrected_image.astype(np.float32) / 255.0, axis=(0, 1))
+                avg_color_after = np.array(cv2.mean(corrected_image)[:3]) / 255.0
                 print(f"Average color channels after correction: R={avg_color_after[0]:.3f}, G={avg_color_after[1]:.3f}, B={avg_color_after[2]:.3f}")
                 
                 image = corrected_image
                 
-                hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-                h, s, v = cv2.split(hsv)
-
-                # Calculate current average brightness
-                avg_v = np.mean(v)
+                # Calculate current average brightness (HSV value is the
+                # per-pixel channel maximum)
+                avg_v = image.max(axis=2).mean()
 
                 # Calculate scaling factor
                 if avg_v == 0:
@@ -127,16 +125,13 @@ class CameraModule:
                 else:
                     scale = target_brightness / avg_v
 
-                # Apply scaling and clip to [0, 255]
-                v = np.clip(v * scale, 0, 255).astype(np.uint8)
-
-                # Merge and convert back to BGR
-                normalized_hsv = cv2.merge((h, s, v))
-                
-                image = cv2.cvtColor(normalized_hsv, cv2.COLOR_HSV2BGR)
+                # Scaling every channel by the same factor scales V and keeps
+                # hue and saturation; values saturate at 255
+                image = cv2.convertScaleAbs(image, alpha=scale)
                 
                 # Save corrected version with a different name
-                corrected_filename = filename.split('.')[0] + '_corrected.' + filename.split('.')[1]
+                path = Path(filename)
+                corrected_filename = str(path.with_name(path.stem + "_corrected" + path.suffix))
                 cv2.imwrite(corrected_filename, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
                 print(f"Color-corrected image saved as {corrected_filename}")
             
@@ -2,11 +2,8 @@
 # CAMERA MODULE CODE - FINAL VERSION
 # =============================
 
-import time
 from picamera2 import Picamera2
 import numpy as np
-import imageio
-import io
 import cv2
 import json
 import os
@@ -77,16 +74,17 @@ class CameraModule:
             "Contrast": 1.0,
         })
         print("Camera warming up...")
+        # Each capture_array() waits for the next frame from the running
+        # pipeline, so the warm-up frames are taken back to back
         for i in range(5):
             _ = self.camera.capture_array()
-            time.sleep(0.5)
             print(f"Warm-up frame {i+1}/5")
+        # The camera keeps running until close() so captures do not pay for
+        # a pipeline restart
         print("Camera initialization complete")
-        self.camera.stop()
 
-    def capture_image(self, apply_color_correction=True, byte_image=True, filename="bright_image.jpg", auto_adjust=True, save_preview=True):
+    def capture_image(self, apply_color_correction=True, byte_image=True, filename="bright_image.jpg", auto_adjust=True, save_preview=True, save_to_disk=True):
         self.load_camera_settings()
-        self.camera.start()
         try:
             self.camera.set_controls({
                 "ExposureTime": self.saved_exposure,
@@ -97,12 +95,13 @@ class CameraModule:
                 "Brightness": 0.0,
                 "Contrast": 1.0,
             })
-            time.sleep(1.0)
+            self._wait_for_controls(self.saved_exposure, self.saved_gain)
             test_image = self.camera.capture_array()
             current_brightness = np.mean(test_image)
             print(f"Current brightness: {current_brightness:.1f} (target: {self.target_brightness})")
 
-            if save_preview:
+            # A capture that must stay off the SD card writes no preview either
+            if save_preview and save_to_disk:
                 cv2.imwrite("preview.jpg", cv2.cvtColor(test_image, cv2.COLOR_RGB2BGR))
                 print("Preview image saved as preview.jpg")
 
@@ -123,7 +122,7 @@ class CameraModule:
 
                 self.camera.set_controls({"ExposureTime": new_exposure, "AnalogueGain": new_gain})
                 print(f"Adjusted: Exposure={new_exposure}us, Gain={new_gain:.2f}")
-                time.sleep(1.0)
+                self._wait_for_controls(new_exposure, new_gain)
                 #self.save_camera_settings(new_exposure, new_gain, self.target_brightness)
                 self.saved_exposure = new_exposure
                 self.saved_gain = new_gain
@@ -134,34 +133,62 @@ class CameraModule:
 
             if apply_color_correction:
                 image = self._apply_color_correction(image)
-                corrected_filename = filename.replace('.jpg', '_corrected.jpg')
-                cv2.imwrite(corrected_filename, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
-                print(f"Color-corrected image saved as {corrected_filename}")
 
-            cv2.imwrite(filename, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
-            print(f"Image saved as {filename}")
+            if not (byte_image or save_to_disk):
+                return image
+
+            # Encode once; the saved files and the returned bytes are the same JPEG
+            bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+            ok, buf = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, 95])
+            if not ok:
+                print("Error capturing image: JPEG encoding failed")
+                return None
+            image_bytes = buf.tobytes()
+
+            if save_to_disk:
+                if apply_color_correction:
+                    corrected_filename = filename.replace('.jpg', '_corrected.jpg')
+                    with open(corrected_filename, 'wb') as f:
+                        f.write(image_bytes)
+                    print(f"Color-corrected image saved as {corrected_filename}")
+
+                with open(filename, 'wb') as f:
+                    f.write(image_bytes)
+                print(f"Image saved as {filename}")
 
             if byte_image:
-                with io.BytesIO() as image_io:
-                    imageio.imwrite(image_io, image, format='jpg')
-                    return image_io.getvalue()
+                return image_bytes
             return image
         except Exception as e:
             print(f"Error capturing image: {e}")
             return None
-        finally:
-            self.camera.stop()
+
+    def _wait_for_controls(self, exposure, gain, max_frames=10):
+        # Return once frame metadata reports the requested exposure and gain,
+        # or after max_frames frames if the sensor clamps them; each
+        # capture_metadata() call waits for the next frame
+        for _ in range(max_frames):
+            metadata = self.camera.capture_metadata()
+            if (abs(metadata.get('ExposureTime', 0) - exposure) <= exposure * 0.05
+                    and abs(metadata.get('AnalogueGain', 0) - gain) <= 0.1):
+                return True
+        return False
 
     def _apply_color_correction(self, image):
         print("Applying color correction...")
-        image_float = image.astype(np.float32) / 255.0
-        avg_color = np.mean(image_float, axis=(0, 1))
+        avg_color = image.reshape(-1, 3).mean(axis=0) / 255.0
         print(f"Average color channels: R={avg_color[0]:.3f}, G={avg_color[1]:.3f}, B={avg_color[2]:.3f}")
         gray_world_scale = np.mean(avg_color) / avg_color
         gray_world_scale = np.clip(gray_world_scale, 0.5, 2.0)
-        corrected_image = image_float * gray_world_scale
-        corrected_image = np.clip(corrected_image, 0, 1) * 255
-        return corrected_image.astype(np.uint8)
+        # Integer scaling in 7-bit fixed point: 255 * 2.0 * 128 still fits in
+        # uint16 and the shift truncates like the old float path, but the gain
+        # is rounded to 1/128, so a pixel can differ from it by 1 LSB.
+        scale_q7 = np.round(gray_world_scale * 128).astype(np.uint16)
+        corrected_image = np.multiply(image, scale_q7, dtype=np.uint16)
+        np.right_shift(corrected_image, 7, out=corrected_image)
+        np.minimum(corrected_image, 255, out=corrected_image)
+        image[:] = corrected_image
+        return image
 
     def close(self):
         if hasattr(self, 'camera'):
@@ -2,27 +2,109 @@
 # CAMERA MODULE CODE
 #=============================
 
-import time
-from picamera2 import Picamera2
+from picamera2 import Picamera2, MappedArray
+from pathlib import Path
 import numpy as np
-import imageio
-import io
 import cv2
 
+try:
+    from turbojpeg import TurboJPEG
+except ImportError:
+    TurboJPEG = None
+
+try:
+    from numba import njit, prange
+except ImportError:  # optional; capture_image falls back to OpenCV
+    njit = None
+    prange = range
+
+def _balanced_value_mean(image, gains):
+    # Mean HSV value (per-pixel channel maximum) the frame would have after
+    # applying gains, without writing the scaled frame
+    height, width, channels = image.shape
+    total = 0.0
+    for y in prange(height):
+        for x in range(width):
+            v = 0.0
+            for c in range(channels):
+                scaled = image[y, x, c] * gains[c]
+                if scaled > v:
+                    v = scaled
+            total += v
+    return total / (height * width)
+
+def _scale_channels(image, gains, out):
+    # Multiply each channel by its gain and saturate to uint8 in a single pass
+    height, width, channels = image.shape
+    for y in prange(height):
+        for x in range(width):
+            for c in range(channels):
+                v = image[y, x, c] * gains[c]
+                out[y, x, c] = 255 if v > 255.0 else np.uint8(v)
+    return out
+
+if njit is not None:
+    _balanced_value_mean = njit(parallel=True, cache=True, fastmath=True)(_balanced_value_mean)
+    _scale_channels = njit(parallel=True, cache=True, fastmath=True)(_scale_channels)
+
+def _value_channel(image):
+    # HSV value is the per-pixel maximum of the colour channels; no HSV conversion needed
+    c0, c1, c2 = cv2.split(image)
+    return cv2.max(cv2.max(c0, c1), c2)
+
 class CameraModule:
     def __init__(self):
         """
         Initialize the camera module.
         """
         self.camera = Picamera2()
-        config = self.camera.create_still_configuration(main={"size": (800, 600)})
+        config = self.camera.create_still_configuration(main={"size": (800, 600)}, buffer_count=3)
         self.camera.configure(config)
         self.camera.options['quality'] = 95 
 
+        # Keep the pipeline running between captures; close() stops it
+        self.camera.start()
+
         self.camera.exposure_mode = 'auto'
         self.camera.automatic_gain_control = True  # Enable AGC
 
-    def capture_image(self, apply_color_correction=True, byte_image=True, filename="bright_image.jpg"):
+        # Optional libjpeg-turbo encoder writing into a buffer kept across captures;
+        # the package imports even when libturbojpeg itself cannot be loaded
+        self._tj = None
+        if TurboJPEG is not None:
+            try:
+                self._tj = TurboJPEG()
+            except (OSError, RuntimeError) as e:
+                print(f"TurboJPEG unavailable, using OpenCV encoder: {e}")
+        self._jpeg_buf = None
+
+        # Frame buffers reused by every capture instead of allocating ~1.4 MB each
+        self._frame_buf = np.empty((600, 800, 3), dtype=np.uint8)
+        self._corrected_buf = np.empty_like(self._frame_buf)
+        self._bgr_buf = np.empty_like(self._frame_buf)
+
+    def _capture_frame(self):
+        """Copy the next frame from the camera's own buffer into self._frame_buf."""
+        height, width = self._frame_buf.shape[:2]
+        with self.camera.captured_request() as request:
+            with MappedArray(request, "main") as mapped:
+                np.copyto(self._frame_buf, mapped.array[:height, :width, :3])
+        return self._frame_buf
+
+    def _encode_jpeg(self, bgr):
+        """Encode a BGR frame to JPEG bytes at quality 95."""
+        if self._tj is None:
+            ok, buf = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, 95])
+            if not ok:
+                raise RuntimeError("JPEG encoding failed")
+            return buf.tobytes()
+
+        if self._jpeg_buf is None:
+            self._jpeg_buf = bytearray(self._tj.buffer_size(bgr))
+        self._jpeg_buf, size = self._tj.encode(bgr, quality=95, dst=self._jpeg_buf)
+        return bytes(memoryview(self._jpeg_buf)[:size])
+
+    def capture_image(self, apply_color_correction=True, byte_image=True, filename="bright_image.jpg", save_to_disk=True):
         """
         Capture an image with color correction option.
 
@@ -30,16 +112,15 @@ class CameraModule:
             apply_color_correction (bool): Whether to apply color correction. Default is True.
             byte_image (bool): Whether to return JPEG encoded image data as bytes. Default is True.
             filename (str): Filename to save the image.
+            save_to_disk (bool): Whether to write the image files. Default is True.
 
         Returns:
             bytes or np.ndarray: JPEG encoded image data or raw image array
         """
-        self.camera.start()
-
         try:
-            preview = self.camera.capture_file("Image.jpg")
-            preview = cv2.imread("Image.jpg")
-            avg_brightness = np.mean(preview)
+            # Meter straight from an in-memory frame rather than a JPEG round-trip through disk
+            preview = self._capture_frame()
+            avg_brightness = sum(cv2.mean(preview)[:3]) / 3
             print(f"Initial average brightness: {avg_brightness}")
 
             metadata = self.camera.capture_metadata()
@@ -66,61 +147,97 @@ class CameraModule:
             })
 
             print(f"Applying adaptive settings - Exposure: {new_exp}μs, Gain: {new_gain}")
-            time.sleep(2)
+            self._wait_for_controls(new_exp, new_gain)
 
-            image = self.camera.capture_array()
+            image = self._capture_frame()
 
-            final_brightness = np.mean(image)
+            final_brightness = sum(cv2.mean(image)[:3]) / 3
             print(f"Final average brightness: {final_brightness}")
 
-            self.camera.stop()
-
             if apply_color_correction:
                 print("Applying color correction...")
-                image_float = image.astype(np.float32) / 255.0
-                avg_color = np.mean(image_float, axis=(0, 1))
+                avg_color = np.array(cv2.mean(image)[:3]) / 255.0
                 print(f"Average color channels before correction: R={avg_color[0]:.3f}, G={avg_color[1]:.3f}, B={avg_color[2]:.3f}")
 
                 scale = 1 / avg_color
                 scale /= np.max(scale)
-                corrected_image = image_float * scale
-                corrected_image = np.clip(corrected_image, 0, 1) * 255
-                corrected_image = corrected_image.astype(np.uint8)
-
-                avg_color_after = np.mean(corrected_image.astype(np.float32) / 255.0, axis=(0, 1))
-                print(f"Average color channels after correction: R={avg_color_after[0]:.3f}, G={avg_color_after[1]:.3f}, B={avg_color_after[2]:.3f}")
-
-                image = corrected_image
-
-                hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-                h, s, v = cv2.split(hsv)
-                avg_v = np.mean(v)
-                scale = target_brightness / avg_v if avg_v != 0 else 1
-                v = np.clip(v * scale, 0, 255).astype(np.uint8)
-                normalized_hsv = cv2.merge((h, s, v))
-                image = cv2.cvtColor(normalized_hsv, cv2.COLOR_HSV2BGR)
-
-                corrected_filename = filename.split('.')[0] + '_corrected.' + filename.split('.')[1]
-                cv2.imwrite(corrected_filename, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
-                print(f"Color-corrected image saved as {corrected_filename}")
-
-            cv2.imwrite(filename, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
-            print(f"Image saved as {filename}")
+                balanced = np.max(np.abs(scale - 1.0)) < 0.02
+                # A frame already within 2% of neutral keeps its colours untouched
+                wb = np.ones(3) if balanced else scale
+
+                # Mean HSV value (per-pixel channel maximum) after white balance;
+                # both paths measure it, then share one rule for what to correct
+                if njit is not None:
+                    avg_v = _balanced_value_mean(image, wb)
+                else:
+                    if not balanced:
+                        # Per-channel gains as a 3-channel 256-entry table, applied in one uint8 pass
+                        lut = np.clip(np.arange(256)[:, None] * wb, 0, 255).astype(np.uint8)
+                        image = cv2.LUT(image, lut.reshape(256, 1, 3), dst=self._corrected_buf)
+                    avg_v = cv2.mean(_value_channel(image))[0]
+                adjust_brightness = abs(avg_v - target_brightness) > 0.05 * target_brightness
+
+                if balanced and not adjust_brightness:
+                    print("Colors and brightness already balanced, skipping correction")
+                else:
+                    avg_color_after = avg_color * wb
+                    print(f"Average color channels after correction: R={avg_color_after[0]:.3f}, G={avg_color_after[1]:.3f}, B={avg_color_after[2]:.3f}")
+                    # Scaling V by k is the same as scaling every channel by k, so skip the HSV round-trip
+                    k = target_brightness / avg_v if adjust_brightness and avg_v != 0 else 1
+                    if njit is not None:
+                        # Both corrections are per-channel gains, so fold the brightness
+                        # scale into the white balance and apply them in one compiled pass
+                        image = _scale_channels(image, wb * k, self._corrected_buf)
+                    elif k != 1:
+                        image = cv2.convertScaleAbs(image, dst=self._corrected_buf, alpha=k)
+
+            if not (byte_image or save_to_disk):
+                # The frame buffers are reused by the next capture, so hand back a copy
+                return image.copy()
+
+            # Convert and encode once; both saved files and the returned bytes share the result
+            bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=self._bgr_buf)
+            image_bytes = self._encode_jpeg(bgr)
+
+            if save_to_disk:
+                if apply_color_correction:
+                    path = Path(filename)
+                    corrected_filename = str(path.with_name(path.stem + "_corrected" + path.suffix))
+                    with open(corrected_filename, 'wb') as f:
+                        f.write(image_bytes)
+                    print(f"Color-corrected image saved as {corrected_filename}")
+
+                with open(filename, 'wb') as f:
+                    f.write(image_bytes)
+                print(f"Image saved as {filename}")
 
             if byte_image:
-                with io.BytesIO() as image_io:
-                    imageio.imwrite(image_io, image, format='jpg')
-                    image_bytes = image_io.getvalue()
-                    print(f"Image captured successfully. Size: {len(image_bytes)} bytes")
-                    return image_bytes
+                print(f"Image captured successfully. Size: {len(image_bytes)} bytes")
+                return image_bytes
 
-            return image
+            # The frame buffers are reused by the next capture, so hand back a copy
+            return image.copy()
 
         except Exception as e:
             print(f"Error capturing image: {e}")
             return None
-        finally:
-            self.camera.stop()
+
+    def _wait_for_controls(self, exposure, gain, max_frames=10):
+        """
+        Wait until frame metadata reports the requested exposure and gain.
+
+        Each capture_metadata call returns on the next frame, so this usually
+        settles within a few frames instead of a fixed delay.
+
+        Returns:
+            bool: True if the controls took effect within max_frames frames
+        """
+        for _ in range(max_frames):
+            metadata = self.camera.capture_metadata()
+            if (abs(metadata.get('ExposureTime', 0) - exposure) <= exposure * 0.05
+                    and abs(metadata.get('AnalogueGain', 0) - gain) <= 0.1):
+                return True
+        return False
 
     def get_image_size(self, image_bytes):
         return len(image_bytes) if image_bytes else 0
@@ -142,6 +259,7 @@ class CameraModule:
 
 if __name__ == "__main__":
     import argparse
+    import shlex
     import sys
 
     parser = argparse.ArgumentParser(description="Camera Module CLI")
@@ -149,20 +267,47 @@ if __name__ == "__main__":
     parser.add_argument("--filename", type=str, default="captured_via_ssh.jpg", help="Filename to save the image")
     parser.add_argument("--no-correction", action="store_true", help="Skip color correction")
     parser.add_argument("--no-bytes", action="store_true", help="Do not return bytes (just save image)")
+    parser.add_argument("--count", type=int, default=1, help="Number of images to capture with --capture")
+    parser.add_argument("--serve", action="store_true",
+                        help="Keep the camera open and read one set of capture options per line from stdin")
+
+    def run_captures(cam, args):
+        path = Path(args.filename)
+        for i in range(args.count):
+            filename = args.filename if args.count == 1 else str(path.with_name(f"{path.stem}_{i + 1}{path.suffix}"))
+            print("[SSH Command] Capturing image...")
+            cam.capture_image(
+                apply_color_correction=not args.no_correction,
+                byte_image=not args.no_bytes,
+                filename=filename
+            )
+            print(f"[SSH Command] Image saved as {filename}")
 
     args = parser.parse_args()
 
     cam = CameraModule()
 
-    if args.capture:
-        print("[SSH Command] Capturing image...")
-        cam.capture_image(
-            apply_color_correction=not args.no_correction,
-            byte_image=not args.no_bytes,
-            filename=args.filename
-        )
-        print(f"[SSH Command] Image saved as {args.filename}")
-    else:
-        print("No action specified. Use --capture to capture an image.")
-
-    cam.close()
+    try:
+        if args.serve:
+            # One process serves many SSH-driven captures without reinitialising the camera
+            print("[SSH Command] Ready; enter capture options per line, 'quit' to exit")
+            for line in sys.stdin:
+                line = line.strip()
+                if line == "quit":
+                    break
+                if not line:
+                    continue
+                try:
+                    line_args = parser.parse_args(shlex.split(line))
+                except ValueError as e:  # e.g. unbalanced quotes
+                    print(f"[SSH Command] Invalid line: {e}")
+                    continue
+                except SystemExit:
+                    continue
+                run_captures(cam, line_args)
+        elif args.capture:
+            run_captures(cam, args)
+        else:
+            print("No action specified. Use --capture to capture an image.")
+    finally:
+        cam.close()
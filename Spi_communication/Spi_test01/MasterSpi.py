@@ -6,9 +6,12 @@ import spidev
 import time
 import json
 import os
+import struct
 import datetime
 import logging
+from logging.handlers import MemoryHandler
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
 from dataclasses import dataclass
 from enum import Enum
@@ -17,6 +20,17 @@ import sys
 # Import your existing modules
 from image_packet_handler import decode_packets_to_image
 
+try:
+    import orjson  # parses packet bytes directly, no decode step
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# Bulk packet transfer: [u32 body_len][u32 n_packets] then n x ([u32 pkt_len][pkt json])
+BLOB_HEADER = struct.Struct('<II')
+PACKET_LEN = struct.Struct('<I')
+SPI_CHUNK_SIZE = 4096  # spidev's default per-transfer buffer limit
+
 class LogLevel(Enum):
     DEBUG = "DEBUG"
     INFO = "INFO"
@@ -29,6 +43,7 @@ class SlaveConfig:
     slave_id: int
     spi_bus: int
     spi_device: int
+    max_speed_hz: int = 16_000_000  # lower for long cable runs
     status: str = "DISCONNECTED"
     last_response: Optional[str] = None
     packet_count: int = 0
@@ -83,8 +98,9 @@ class SPILogger:
         if self.console_output:
             console_handler.setFormatter(formatter)
         
-        # Add handlers to logger
-        self.logger.addHandler(file_handler)
+        # Add handlers to logger; per-transaction logs are buffered and written
+        # out in batches, or straight away when an error is logged
+        self.logger.addHandler(MemoryHandler(1024, flushLevel=logging.ERROR, target=file_handler))
         self.logger.addHandler(error_handler)
         if self.console_output:
             self.logger.addHandler(console_handler)
@@ -95,15 +111,18 @@ class SPILogger:
     
     def log_spi_transaction(self, slave_id: int, command: str, response: str = None, success: bool = True):
         """Log SPI communication details"""
+        level = logging.INFO if success else logging.ERROR
+        if not self.logger.isEnabledFor(level):
+            return
+        
         status = "SUCCESS" if success else "FAILED"
-        message = f"SPI[Slave-{slave_id}] CMD: {command} | STATUS: {status}"
         if response:
-            message += f" | RESPONSE: {response[:50]}{'...' if len(response) > 50 else ''}"
-        
-        if success:
-            self.logger.info(message)
+            if len(response) > 50:
+                response = response[:50] + '...'
+            self.logger.log(level, "SPI[Slave-%d] CMD: %s | STATUS: %s | RESPONSE: %s",
+                            slave_id, command, status, response)
         else:
-            self.logger.error(message)
+            self.logger.log(level, "SPI[Slave-%d] CMD: %s | STATUS: %s", slave_id, command, status)
     
     def log_image_operation(self, slave_id: int, operation: str, details: Dict):
         """Log image capture and processing operations"""
@@ -140,6 +159,7 @@ class MasterController:
         self.logger = SPILogger()
         self.output_dir = output_dir
         self.spi_connections = {}
+        self.spi_locks = {}
         self.slaves_data = {}
         
         # Configure slaves
@@ -168,14 +188,20 @@ class MasterController:
             try:
                 spi = spidev.SpiDev()
                 spi.open(slave.spi_bus, slave.spi_device)
-                spi.max_speed_hz = 1000000  # 1MHz
+                spi.max_speed_hz = slave.max_speed_hz
                 spi.mode = 0
+                spi.bits_per_word = 8
+                spi.no_cs = False
                 
                 self.spi_connections[slave.slave_id] = spi
+                # Each slave's device is used from its own worker thread; the lock keeps
+                # a command and its follow-up reads together
+                self.spi_locks[slave.slave_id] = threading.RLock()
                 slave.status = "CONNECTED"
                 
                 self.logger.logger.info(
-                    f"Slave-{slave.slave_id} connected on SPI{slave.spi_bus}.{slave.spi_device}"
+                    f"Slave-{slave.slave_id} connected on SPI{slave.spi_bus}.{slave.spi_device} "
+                    f"at {slave.max_speed_hz / 1e6:g}MHz"
                 )
                 
                 # Test connection
@@ -217,10 +243,11 @@ class MasterController:
             cmd_length = len(cmd_bytes)
             
             # Send command length first, then command
-            spi.xfer2([cmd_length])
-            time.sleep(0.01)  # Small delay
-            
-            response_bytes = spi.xfer2(cmd_bytes)
+            with self.spi_locks[slave_id]:
+                spi.xfer2([cmd_length])
+                time.sleep(0.01)  # Small delay
+                
+                response_bytes = spi.xfer2(cmd_bytes)
             response = bytes(response_bytes).decode('utf-8', errors='ignore')
             
             self.logger.log_spi_transaction(slave_id, command, response, True)
@@ -230,116 +257,133 @@ class MasterController:
             self.logger.log_spi_transaction(slave_id, command, str(e), False)
             return None
     
+    def read_bytes(self, spi, length: int) -> bytearray:
+        """Clock in length bytes from a slave, in transfers spidev can handle"""
+        data = bytearray()
+        while len(data) < length:
+            n = min(SPI_CHUNK_SIZE, length - len(data))
+            data += bytes(spi.readbytes(n))
+        return data
+    
     def broadcast_capture_command(self) -> Dict[int, bool]:
         """Broadcast capture command to all slaves"""
         self.logger.logger.info("Broadcasting capture command to all slaves...")
         
-        capture_results = {}
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         
-        for slave in self.slave_configs:
-            if slave.status != "READY":
-                self.logger.logger.warning(f"Skipping Slave-{slave.slave_id} - Status: {slave.status}")
-                capture_results[slave.slave_id] = False
-                continue
+        # Slaves are independent devices, so trigger them all at once
+        with ThreadPoolExecutor(max_workers=len(self.slave_configs)) as executor:
+            futures = {
+                slave.slave_id: executor.submit(self.capture_on_slave, slave, timestamp)
+                for slave in self.slave_configs
+            }
+            return {slave_id: future.result() for slave_id, future in futures.items()}
+    
+    def capture_on_slave(self, slave: SlaveConfig, timestamp: str) -> bool:
+        """Send the capture command to one slave"""
+        if slave.status != "READY":
+            self.logger.logger.warning(f"Skipping Slave-{slave.slave_id} - Status: {slave.status}")
+            return False
+        
+        try:
+            response = self.send_command(slave.slave_id, f"CAPTURE:{timestamp}")
+            success = bool(response and "CAPTURE_STARTED" in response)
             
-            try:
-                response = self.send_command(slave.slave_id, f"CAPTURE:{timestamp}")
-                success = response and "CAPTURE_STARTED" in response
-                capture_results[slave.slave_id] = success
+            if success:
+                self.logger.log_image_operation(
+                    slave.slave_id, 
+                    "CAPTURE_INITIATED",
+                    {"timestamp": timestamp, "status": "SUCCESS"}
+                )
+            else:
+                self.logger.logger.error(f"Capture command failed for Slave-{slave.slave_id}")
+            return success
                 
-                if success:
-                    self.logger.log_image_operation(
-                        slave.slave_id, 
-                        "CAPTURE_INITIATED",
-                        {"timestamp": timestamp, "status": "SUCCESS"}
-                    )
-                else:
-                    self.logger.logger.error(f"Capture command failed for Slave-{slave.slave_id}")
-                    
-            except Exception as e:
-                capture_results[slave.slave_id] = False
-                self.logger.logger.error(f"Error sending capture command to Slave-{slave.slave_id}: {str(e)}")
-        
-        return capture_results
+        except Exception as e:
+            self.logger.logger.error(f"Error sending capture command to Slave-{slave.slave_id}: {str(e)}")
+            return False
     
     def wait_for_capture_completion(self, timeout: int = 60) -> Dict[int, bool]:
         """Wait for all slaves to complete image capture"""
         self.logger.logger.info("Waiting for slaves to complete image capture...")
         
-        completion_status = {}
         start_time = time.time()
         
-        for slave in self.slave_configs:
-            if slave.status != "READY":
-                completion_status[slave.slave_id] = False
-                continue
-                
-            completed = False
-            slave_start_time = time.time()
-            
-            while not completed and (time.time() - slave_start_time) < timeout:
-                try:
-                    response = self.send_command(slave.slave_id, "STATUS")
-                    if response and "CAPTURE_COMPLETE" in response:
-                        completed = True
-                        self.logger.log_image_operation(
-                            slave.slave_id,
-                            "CAPTURE_COMPLETED",
-                            {"duration": f"{time.time() - slave_start_time:.2f}s"}
-                        )
-                    elif response and "ERROR" in response:
-                        break
-                    else:
-                        time.sleep(1)  # Wait before next status check
-                        
-                except Exception as e:
-                    self.logger.logger.error(f"Error checking status for Slave-{slave.slave_id}: {str(e)}")
-                    break
-            
-            completion_status[slave.slave_id] = completed
-            
-            if not completed:
-                self.logger.logger.error(f"Slave-{slave.slave_id} capture timeout or failed")
+        # Poll every slave concurrently so one slow slave doesn't hold up the rest
+        with ThreadPoolExecutor(max_workers=len(self.slave_configs)) as executor:
+            futures = {
+                slave.slave_id: executor.submit(self.wait_for_slave, slave, timeout)
+                for slave in self.slave_configs
+            }
+            completion_status = {slave_id: future.result() for slave_id, future in futures.items()}
         
         total_time = time.time() - start_time
         self.logger.logger.info(f"Capture phase completed in {total_time:.2f}s")
         
         return completion_status
     
+    def wait_for_slave(self, slave: SlaveConfig, timeout: int) -> bool:
+        """Poll one slave until its capture completes, fails or times out"""
+        if slave.status != "READY":
+            return False
+            
+        completed = False
+        slave_start_time = time.time()
+        
+        while not completed and (time.time() - slave_start_time) < timeout:
+            try:
+                response = self.send_command(slave.slave_id, "STATUS")
+                if response and "CAPTURE_COMPLETE" in response:
+                    completed = True
+                    self.logger.log_image_operation(
+                        slave.slave_id,
+                        "CAPTURE_COMPLETED",
+                        {"duration": f"{time.time() - slave_start_time:.2f}s"}
+                    )
+                elif response and "ERROR" in response:
+                    break
+                else:
+                    time.sleep(1)  # Wait before next status check
+                    
+            except Exception as e:
+                self.logger.logger.error(f"Error checking status for Slave-{slave.slave_id}: {str(e)}")
+                break
+        
+        if not completed:
+            self.logger.logger.error(f"Slave-{slave.slave_id} capture timeout or failed")
+        
+        return completed
+    
     def receive_image_packets(self, slave_id: int) -> List[Dict]:
         """Receive image packets from a specific slave"""
         self.logger.logger.info(f"Receiving image packets from Slave-{slave_id}...")
         
         packets = []
         try:
-            # Request packet count
-            response = self.send_command(slave_id, "GET_PACKET_COUNT")
-            if not response:
-                raise Exception("Failed to get packet count")
-            
-            packet_count = int(response.split(':')[1])
-            self.logger.log_image_operation(
-                slave_id,
-                "PACKET_TRANSFER_START",
-                {"total_packets": packet_count}
-            )
+            # Ask for every packet at once and read them back in a single burst
+            with self.spi_locks[slave_id]:
+                if self.send_command(slave_id, "GET_ALL_PACKETS") is None:
+                    raise Exception("Failed to request packets")
+                
+                spi = self.spi_connections[slave_id]
+                body_len, packet_count = BLOB_HEADER.unpack(self.read_bytes(spi, BLOB_HEADER.size))
+                self.logger.log_image_operation(
+                    slave_id,
+                    "PACKET_TRANSFER_START",
+                    {"total_packets": packet_count, "total_bytes": body_len}
+                )
+                
+                body = self.read_bytes(spi, body_len)
             
-            # Receive each packet
+            offset = 0
             for i in range(packet_count):
-                packet_response = self.send_command(slave_id, f"GET_PACKET:{i}")
-                if packet_response:
-                    try:
-                        packet_data = json.loads(packet_response)
-                        packets.append(packet_data)
-                        
-                        if i % 10 == 0:  # Log progress every 10 packets
-                            self.logger.logger.debug(f"Received packet {i+1}/{packet_count} from Slave-{slave_id}")
-                            
-                    except json.JSONDecodeError as e:
-                        self.logger.logger.error(f"Invalid packet data from Slave-{slave_id}, packet {i}: {str(e)}")
-                else:
-                    self.logger.logger.error(f"Failed to receive packet {i} from Slave-{slave_id}")
+                (packet_len,) = PACKET_LEN.unpack_from(body, offset)
+                offset += PACKET_LEN.size
+                try:
+                    packets.append(loads(body[offset:offset + packet_len]))
+                except json.JSONDecodeError as e:
+                    self.logger.logger.error(f"Invalid packet data from Slave-{slave_id}, packet {i}: {str(e)}")
+                offset += packet_len
             
             self.logger.log_image_operation(
                 slave_id,
@@ -405,11 +449,9 @@ class MasterController:
         self.logger.logger.info(f"{completed_captures}/{successful_captures} slaves completed capture")
         
         # Step 3: Receive image packets
-        all_packets = {}
-        for slave_id, completed in completion_status.items():
-            if completed:
-                packets = self.receive_image_packets(slave_id)
-                all_packets[slave_id] = packets
+        completed_ids = [slave_id for slave_id, completed in completion_status.items() if completed]
+        with ThreadPoolExecutor(max_workers=len(completed_ids)) as executor:
+            all_packets = dict(zip(completed_ids, executor.map(self.receive_image_packets, completed_ids)))
         
         # Step 4: Save images
         self.save_received_images(all_packets)
@@ -438,6 +480,8 @@ class MasterController:
                 self.logger.logger.error(f"Error closing SPI connection for Slave-{slave_id}: {str(e)}")
         
         self.logger.logger.info("Master Controller shutdown complete")
+        for handler in self.logger.logger.handlers:
+            handler.flush()
 
 def main():
     """Main function to run the master controller"""
@@ -6,16 +6,31 @@ import spidev
 import time
 import json
 import os
+import struct
 import datetime
 import logging
 import threading
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union
 import sys
 
 # Import your existing modules
 from camera_module_v4_3 import CameraModule
 from image_packet_handler import encode_image_to_packets
 
+# Bulk packet transfer: [u32 body_len][u32 n_packets] then n x ([u32 pkt_len][pkt json])
+BLOB_HEADER = struct.Struct('<II')
+PACKET_LEN = struct.Struct('<I')
+
+def build_packet_blob(packets: List[Dict]) -> bytes:
+    """Frame all packets into one length-prefixed blob for a single SPI burst"""
+    parts = []
+    for packet in packets:
+        data = json.dumps(packet).encode('utf-8')
+        parts.append(PACKET_LEN.pack(len(data)))
+        parts.append(data)
+    body = b"".join(parts)
+    return BLOB_HEADER.pack(len(body), len(packets)) + body
+
 class SlaveController:
     """
     Slave Raspberry Pi controller that:
@@ -32,6 +47,7 @@ class SlaveController:
         
         # State variables
         self.current_packets = []
+        self.packet_blob = b""
         self.capture_status = "IDLE"  # IDLE, CAPTURING, COMPLETE, ERROR
         self.last_capture_timestamp = None
         self.camera = None
@@ -58,7 +74,8 @@ class SlaveController:
         
         logging.basicConfig(
             level=logging.INFO,
-            format='%(asctime)s | %(levelname)8s | %(funcName)20s | %(message)s',
+            # Logger name instead of funcName, which costs a frame lookup per record
+            format='%(asctime)s | %(levelname)8s | %(name)s | %(message)s',
             handlers=[
                 logging.FileHandler(log_file),
                 logging.StreamHandler(sys.stdout)
@@ -103,16 +120,18 @@ class SlaveController:
                 image_bytes = self.camera.capture_image(
                     apply_color_correction=True,
                     byte_image=True,
-                    filename=filename
+                    filename=filename,
+                    save_to_disk=False  # the image goes to the master over SPI
                 )
                 
                 if image_bytes:
                     # Encode image into packets
                     self.current_packets = encode_image_to_packets(image_bytes, self.slave_id)
+                    self.packet_blob = build_packet_blob(self.current_packets)
                     self.capture_status = "COMPLETE"
                     
-                    self.logger.info(f"Image captured and encoded into {len(self.current_packets)} packets")
-                    self.logger.info(f"Image size: {len(image_bytes)} bytes, saved as: {filename}")
+                    self.logger.info("Image captured and encoded into %d packets", len(self.current_packets))
+                    self.logger.info("Image size: %d bytes", len(image_bytes))
                 else:
                     self.capture_status = "ERROR"
                     self.logger.error("Failed to capture image - no data returned")
@@ -126,9 +145,10 @@ class SlaveController:
         capture_thread.daemon = True
         capture_thread.start()
     
-    def handle_command(self, command: str) -> str:
+    def handle_command(self, command: str) -> Union[str, bytes]:
         """Handle incoming commands from master"""
-        self.logger.info(f"Received command: {command}")
+        # Runs for every GET_PACKET in a transfer; debug level with lazy formatting
+        self.logger.debug("Received command: %s", command)
         
         try:
             if command == "PING":
@@ -158,6 +178,12 @@ class SlaveController:
                 else:
                     return "ERROR:NO_CAPTURE_DATA"
                     
+            elif command == "GET_ALL_PACKETS":
+                if self.capture_status == "COMPLETE":
+                    return self.packet_blob
+                else:
+                    return "ERROR:NO_CAPTURE_DATA"
+                    
             elif command.startswith("GET_PACKET:"):
                 packet_index = int(command.split(":", 1)[1])
                 if (self.capture_status == "COMPLETE" and 
@@ -170,7 +196,7 @@ class SlaveController:
                 return "ERROR:UNKNOWN_COMMAND"
                 
         except Exception as e:
-            self.logger.error(f"Error handling command '{command}': {str(e)}")
+            self.logger.error("Error handling command '%s': %s", command, e)
             return f"ERROR:{str(e)}"
     
     def listen_for_commands(self):
@@ -1,7 +1,12 @@
+import os
 import time
+import queue
+import threading
+import struct
+import zlib
 import spidev
-import RPi.GPIO as GPIO
-import json
+import pigpio
+from spi_batch import read_frames
 from datetime import datetime
 
 # ======== Configuration ========
@@ -12,28 +17,59 @@ CS_PINS = {
     4: 6,
     5: 13,
 }
+# READY inputs: each slave raises its line when its image is ready
+READY_PINS = {
+    1: 17,
+    2: 27,
+    3: 22,
+    4: 23,
+    5: 24,
+}
 CMD_CAPTURE   = 0x01
 CMD_PKT_REQ   = 0x02
 CMD_ACK_READY = 0x03
 
-# ======== Setup ========
-GPIO.setmode(GPIO.BCM)
-for cs in CS_PINS.values():
-    GPIO.setup(cs, GPIO.OUT, initial=GPIO.HIGH)
+# Each 256-byte SPI frame: [u8 slave_id][u16 index][u16 total][u16 payload_len][u32 crc] + raw JPEG bytes
+# crc is the CRC-32 of the whole JPEG in the last frame and 0 in the others
+FRAME_SIZE    = 256
+PKT_HDR       = struct.Struct('<BHHHI')
+PAYLOAD_SIZE  = FRAME_SIZE - PKT_HDR.size
 
+# ======== Setup ========
 spi = spidev.SpiDev()
 spi.open(0, 0)    # bus 0, CE0 (we’ll manually toggle CS for others)
 spi.max_speed_hz = 1_000_000
 spi.mode = 0
 
+# pigpio writes whole GPIO banks, so every CS line changes in one register write
+pi = pigpio.pi()
+if not pi.connected:
+    raise SystemExit("pigpiod is not running (start it with: sudo pigpiod)")
+CS_MASK = 0
+for pin in CS_PINS.values():
+    CS_MASK |= 1 << pin
+# slave_id -> (mask of CS lines to drive high, mask of the CS line to drive low)
+CS_MASKS = {sid: (CS_MASK & ~(1 << pin), 1 << pin) for sid, pin in CS_PINS.items()}
+# Latch every CS high in one bank write before the pins become outputs,
+# so no slave is selected while they are configured
+pi.set_bank_1(CS_MASK)
+for pin in CS_PINS.values():
+    pi.set_mode(pin, pigpio.OUTPUT)
+for pin in READY_PINS.values():
+    pi.set_mode(pin, pigpio.INPUT)
+    pi.set_pull_up_down(pin, pigpio.PUD_DOWN)
+
+# Slaves share MOSI/MISO/SCLK, so only one thread may drive the bus at a time
+bus_lock = threading.Lock()
+
 def select(slave_id):
     """Assert only this slave’s CS low."""
-    for sid, pin in CS_PINS.items():
-        GPIO.output(pin, GPIO.LOW if sid == slave_id else GPIO.HIGH)
+    high, low = CS_MASKS[slave_id]
+    pi.set_bank_1(high)   # release the others first so two slaves are never selected
+    pi.clear_bank_1(low)
 
 def deselect_all():
-    for pin in CS_PINS.values():
-        GPIO.output(pin, GPIO.HIGH)
+    pi.set_bank_1(CS_MASK)
 
 def broadcast_capture():
     print("Broadcasting capture command...")
@@ -44,55 +80,111 @@ def broadcast_capture():
         time.sleep(0.01)
     deselect_all()
 
-def wait_until_ready(slave_id, timeout=10):
-    select(slave_id)
-    start = time.time()
-    while time.time() - start < timeout:
-        resp = spi.xfer2([CMD_ACK_READY, 0x00])
-        # If slave pulls MISO low or returns non-zero ack → ready
-        if resp[1] == 1:
-            break
-        time.sleep(0.1)
-    deselect_all()
+def watch_ready_lines():
+    """Arm a rising-edge watcher on every READY line; call before broadcasting CAPTURE."""
+    watchers = {}
+    for sid, pin in READY_PINS.items():
+        ready = threading.Event()
+        # Only a low→high transition counts, so a line still high from the last cycle is ignored
+        watchers[sid] = (ready, pi.callback(pin, pigpio.RISING_EDGE, lambda *_, ready=ready: ready.set()))
+    return watchers
 
-def retrieve_packets(slave_id):
-    # ask slave how many packets it has
-    select(slave_id)
-    resp = spi.xfer2([CMD_PKT_REQ, 0xFF])  # 0xFF as “query total”
-    total_pkts = resp[1]
-    deselect_all()
+def wait_until_ready(slave_id, watcher, timeout=10):
+    ready, callback = watcher
+    try:
+        return ready.wait(timeout)
+    finally:
+        callback.cancel()
 
-    packets = []
-    for idx in range(total_pkts):
+def retrieve_packets(slave_id):
+    with bus_lock:
+        # ask slave how many packets it has
         select(slave_id)
-        # send [CMD_PKT_REQ, packet_index]
-        resp = spi.xfer2([CMD_PKT_REQ, idx])  
-        # data comes back as a JSON string split over multiple bytes…
-        # Here we read a fixed len block then decode
-        raw = spi.readbytes(256)
+        resp = spi.xfer2([CMD_PKT_REQ, 0xFF])  # 0xFF as “query total”
+        total_pkts = resp[1]
         deselect_all()
+
+        # One request/response ioctl per packet, each framed by its own CS pulse
+        frames = read_frames(spi, CMD_PKT_REQ, total_pkts, FRAME_SIZE,
+                             lambda: select(slave_id), deselect_all)
+
+    payloads = [None] * total_pkts
+    image_crc = None
+    for offset in range(0, len(frames), FRAME_SIZE):
+        sid, index, total, length, crc = PKT_HDR.unpack_from(frames, offset)
+        # A corrupted header is left as a missing packet rather than sliced into the image
+        if sid != slave_id or index != offset // FRAME_SIZE or total != total_pkts or length > PAYLOAD_SIZE:
+            print(f"Decoding error from slave {slave_id} pkt#{offset // FRAME_SIZE}: bad header {(sid, index, total, length)}")
+            continue
+        payloads[index] = bytes(frames[offset + PKT_HDR.size:offset + PKT_HDR.size + length])
+        if index == total_pkts - 1:
+            image_crc = crc
+    return payloads, image_crc
+
+def save_image(slave_id, payloads, image_crc, output_dir):
+    """Join the frame payloads back into the JPEG, check its CRC and write it out."""
+    missing = [i for i, payload in enumerate(payloads) if payload is None]
+    if missing:
+        print(f"Slave {slave_id} image incomplete, missing packets {missing}")
+        return None
+    data = b"".join(payloads)
+    if zlib.crc32(data) != image_crc:
+        print(f"Slave {slave_id} image failed CRC check")
+        return None
+    os.makedirs(output_dir, exist_ok=True)
+    filename = os.path.join(output_dir, f"slave_{slave_id}_{datetime.now():%Y%m%d_%H%M%S}.jpg")
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return filename
+
+def poll_slave(slave_id, watcher, ready_queue):
+    print(f"-- Waiting for Slave {slave_id} ready…")
+    try:
+        ready = wait_until_ready(slave_id, watcher)
+    except Exception as e:
+        # a dead poller would leave main() waiting forever, so report the slave as not ready
+        print(f"Error waiting for Slave {slave_id}: {e}")
+        ready = False
+    ready_queue.put((slave_id, ready))
+
+def retrieve_ready_slaves(ready_queue, retrieved_queue):
+    # Single consumer owning the bus for packet transfers, in the order slaves become ready
+    for _ in CS_PINS:
+        sid, ready = ready_queue.get()
+        if not ready:
+            retrieved_queue.put((sid, None, None))
+            continue
+        print(f"-- Retrieving packets from Slave {sid}…")
         try:
-            pkt = json.loads(bytes(raw).decode('utf-8').rstrip('\x00'))
-            packets.append(pkt)
+            retrieved_queue.put((sid, *retrieve_packets(sid)))
         except Exception as e:
-            print(f"Decoding error from slave {slave_id} pkt#{idx}: {e}")
-    return packets
+            # every slave must yield a result, or main() blocks on the queue forever
+            print(f"Error retrieving packets from Slave {sid}: {e}")
+            retrieved_queue.put((sid, None, None))
 
 def main():
     input("Press Enter to START capture → ")
+    watchers = watch_ready_lines()
     broadcast_capture()
 
+    # Poll every slave at once; a slow slave no longer delays retrieval from the others
+    ready_queue = queue.Queue()
+    retrieved_queue = queue.Queue()
     for sid in CS_PINS:
-        print(f"-- Waiting for Slave {sid} ready…")
-        wait_until_ready(sid)
-        print(f"-- Retrieving packets from Slave {sid}…")
-        pkts = retrieve_packets(sid)
-        from image_packet_handler import decode_packets_to_image
-        out = decode_packets_to_image(pkts, output_dir="./images")
+        threading.Thread(target=poll_slave, args=(sid, watchers[sid], ready_queue), daemon=True).start()
+    threading.Thread(target=retrieve_ready_slaves, args=(ready_queue, retrieved_queue), daemon=True).start()
+
+    # Save each image while the next slave's packets are being retrieved
+    for _ in CS_PINS:
+        sid, payloads, image_crc = retrieved_queue.get()
+        if payloads is None:
+            print(f"Slave {sid} has no image, skipping")
+            continue
+        out = save_image(sid, payloads, image_crc, output_dir="./images")
         print(f"Saved image from Slave {sid} → {out}")
 
     spi.close()
-    GPIO.cleanup()
+    pi.stop()
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,13 @@
+import os
 import time
+import queue
+import threading
+import struct
+import zlib
 import spidev
-import RPi.GPIO as GPIO
+import pigpio
+from spi_batch import read_frames
 from datetime import datetime
-from image_packet_handler import decode_packets_to_image
 
 # ===================== Configuration =====================
 CS_PINS = {
@@ -12,29 +17,59 @@ CS_PINS = {
     4: 6,
     5: 13,
 }
+# READY inputs: each slave raises its line when its image is ready
+READY_PINS = {
+    1: 17,
+    2: 27,
+    3: 22,
+    4: 23,
+    5: 24,
+}
 CMD_CAPTURE   = 0x01
 CMD_PKT_REQ   = 0x02
 CMD_ACK_READY = 0x03
 
-# ===================== SPI Setup =====================
-GPIO.setmode(GPIO.BCM)
-for pin in CS_PINS.values():
-    GPIO.setup(pin, GPIO.OUT)
-    GPIO.output(pin, GPIO.HIGH)  # Deselect all
+# Each 256-byte SPI frame: [u8 slave_id][u16 index][u16 total][u16 payload_len][u32 crc] + raw JPEG bytes
+# crc is the CRC-32 of the whole JPEG in the last frame and 0 in the others
+FRAME_SIZE    = 256
+PKT_HDR       = struct.Struct('<BHHHI')
+PAYLOAD_SIZE  = FRAME_SIZE - PKT_HDR.size
 
+# ===================== SPI Setup =====================
 spi = spidev.SpiDev()
 spi.open(0, 0)  # Bus 0, Device 0 (we ignore CS0 because we manually toggle)
 spi.max_speed_hz = 500000
 spi.mode = 0
 
+# pigpio writes whole GPIO banks, so every CS line changes in one register write
+pi = pigpio.pi()
+if not pi.connected:
+    raise SystemExit("pigpiod is not running (start it with: sudo pigpiod)")
+CS_MASK = 0
+for pin in CS_PINS.values():
+    CS_MASK |= 1 << pin
+# slave_id -> (mask of CS lines to drive high, mask of the CS line to drive low)
+CS_MASKS = {sid: (CS_MASK & ~(1 << pin), 1 << pin) for sid, pin in CS_PINS.items()}
+# Latch every CS high in one bank write before the pins become outputs,
+# so no slave is selected while they are configured
+pi.set_bank_1(CS_MASK)
+for pin in CS_PINS.values():
+    pi.set_mode(pin, pigpio.OUTPUT)
+for pin in READY_PINS.values():
+    pi.set_mode(pin, pigpio.INPUT)
+    pi.set_pull_up_down(pin, pigpio.PUD_DOWN)
+
+# Slaves share MOSI/MISO/SCLK, so only one thread may drive the bus at a time
+bus_lock = threading.Lock()
+
 def select_slave(slave_id):
-    for sid, pin in CS_PINS.items():
-        GPIO.output(pin, GPIO.LOW if sid == slave_id else GPIO.HIGH)
+    high, low = CS_MASKS[slave_id]
+    pi.set_bank_1(high)   # release the others first so two slaves are never selected
+    pi.clear_bank_1(low)
     time.sleep(0.001)
 
 def deselect_all():
-    for pin in CS_PINS.values():
-        GPIO.output(pin, GPIO.HIGH)
+    pi.set_bank_1(CS_MASK)
 
 def broadcast_capture():
     for sid in CS_PINS:
@@ -43,58 +78,116 @@ def broadcast_capture():
         deselect_all()
         time.sleep(0.01)
 
-def wait_for_slave_ready(slave_id, timeout=15):
-    select_slave(slave_id)
-    print(f"Polling slave {slave_id} for readiness...")
-    start = time.time()
-    while time.time() - start < timeout:
-        resp = spi.xfer2([CMD_ACK_READY, 0x00])
-        if resp[1] == 1:
-            deselect_all()
+def watch_ready_lines():
+    """Arm a rising-edge watcher on every READY line; call before broadcasting CAPTURE."""
+    watchers = {}
+    for sid, pin in READY_PINS.items():
+        ready = threading.Event()
+        # Only a low→high transition counts, so a line still high from the last cycle is ignored
+        watchers[sid] = (ready, pi.callback(pin, pigpio.RISING_EDGE, lambda *_, ready=ready: ready.set()))
+    return watchers
+
+def wait_for_slave_ready(slave_id, watcher, timeout=15):
+    print(f"Waiting for slave {slave_id} READY line...")
+    ready, callback = watcher
+    try:
+        if ready.wait(timeout):
             print(f"✔ Slave {slave_id} ready.")
             return True
-        time.sleep(0.25)
-    deselect_all()
+    finally:
+        callback.cancel()
     print(f"✖ Timeout waiting for slave {slave_id}")
     return False
 
 def retrieve_packets(slave_id):
-    select_slave(slave_id)
-    resp = spi.xfer2([CMD_PKT_REQ, 0xFF])
-    total_pkts = resp[1]
-    deselect_all()
-    print(f"Retrieving {total_pkts} packets from slave {slave_id}...")
-
-    packets = []
-    for i in range(total_pkts):
+    with bus_lock:
         select_slave(slave_id)
-        spi.xfer2([CMD_PKT_REQ, i])
-        raw = spi.readbytes(256)
+        resp = spi.xfer2([CMD_PKT_REQ, 0xFF])
+        total_pkts = resp[1]
         deselect_all()
+        print(f"Retrieving {total_pkts} packets from slave {slave_id}...")
+
+        # One request/response ioctl per packet, each framed by its own CS pulse
+        frames = read_frames(spi, CMD_PKT_REQ, total_pkts, FRAME_SIZE,
+                             lambda: select_slave(slave_id), deselect_all)
+
+    payloads = [None] * total_pkts
+    image_crc = None
+    for offset in range(0, len(frames), FRAME_SIZE):
+        sid, index, total, length, crc = PKT_HDR.unpack_from(frames, offset)
+        # A corrupted header is left as a missing packet rather than sliced into the image
+        if sid != slave_id or index != offset // FRAME_SIZE or total != total_pkts or length > PAYLOAD_SIZE:
+            print(f"Packet decode error: bad header {(sid, index, total, length)}")
+            continue
+        payloads[index] = bytes(frames[offset + PKT_HDR.size:offset + PKT_HDR.size + length])
+        if index == total_pkts - 1:
+            image_crc = crc
+    return payloads, image_crc
 
+def save_image(slave_id, payloads, image_crc, output_dir):
+    """Join the frame payloads back into the JPEG, check its CRC and write it out."""
+    missing = [i for i, payload in enumerate(payloads) if payload is None]
+    if missing:
+        print(f"Slave {slave_id} image incomplete, missing packets {missing}")
+        return None
+    data = b"".join(payloads)
+    if zlib.crc32(data) != image_crc:
+        print(f"Slave {slave_id} image failed CRC check")
+        return None
+    os.makedirs(output_dir, exist_ok=True)
+    filename = os.path.join(output_dir, f"slave_{slave_id}_{datetime.now():%Y%m%d_%H%M%S}.jpg")
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return filename
+
+def poll_slave(slave_id, watcher, ready_queue):
+    try:
+        ready = wait_for_slave_ready(slave_id, watcher)
+    except Exception as e:
+        # a dead poller would leave main() waiting forever, so report the slave as not ready
+        print(f"✖ Error waiting for slave {slave_id}: {e}")
+        ready = False
+    ready_queue.put((slave_id, ready))
+
+def retrieve_ready_slaves(ready_queue, retrieved_queue):
+    # Single consumer owning the bus for packet transfers, in the order slaves finish
+    for _ in CS_PINS:
+        sid, ready = ready_queue.get()
+        if not ready:
+            retrieved_queue.put((sid, None, None))
+            continue
         try:
-            pkt = bytes(raw).decode('utf-8').rstrip('\x00')
-            packets.append(eval(pkt))  # You may use json.loads(pkt) if JSON
+            retrieved_queue.put((sid, *retrieve_packets(sid)))
         except Exception as e:
-            print(f"Packet decode error: {e}")
-    return packets
+            # every slave must yield a result, or main() blocks on the queue forever
+            print(f"✖ Error retrieving packets from slave {sid}: {e}")
+            retrieved_queue.put((sid, None, None))
 
 def main():
     input("Press ENTER to begin capture...")
 
+    watchers = watch_ready_lines()
     print("\n📤 Broadcasting CAPTURE command...")
     broadcast_capture()
 
+    # Poll every slave at once; a slow slave no longer delays retrieval from the others
+    ready_queue = queue.Queue()
+    retrieved_queue = queue.Queue()
     for sid in CS_PINS:
-        if wait_for_slave_ready(sid):
-            packets = retrieve_packets(sid)
-            filename = decode_packets_to_image(packets, output_dir="images")
-            print(f"✅ Image from Slave {sid} saved → {filename}")
-        else:
-            print(f"⚠ Skipping Slave {sid} (not ready)")
+        threading.Thread(target=poll_slave, args=(sid, watchers[sid], ready_queue), daemon=True).start()
+    threading.Thread(target=retrieve_ready_slaves, args=(ready_queue, retrieved_queue), daemon=True).start()
+
+    # Save each image while the next slave's packets are being retrieved
+    for _ in CS_PINS:
+        sid, payloads, image_crc = retrieved_queue.get()
+        if payloads is None:
+            print(f"⚠ Skipping Slave {sid} (no image)")
+            continue
+        filename = save_image(sid, payloads, image_crc, output_dir="images")
+        print(f"✅ Image from Slave {sid} saved → {filename}")
 
     spi.close()
-    GPIO.cleanup()
+    pi.stop()
 
 if __name__ == "__main__":
     main()
@@ -1,63 +1,140 @@
-import time, json
+import struct, atexit, threading, queue, zlib
 import spidev
 import RPi.GPIO as GPIO
 from camera_module_v4_3 import CameraModule       # or your image_Capture.py
-from image_packet_handler import encode_image_to_packets
 
 # ======== Configuration ========
 SLAVE_ID = 1  # set per device 1…5
 CS_PIN   = 8  # must match wiring above
+READY_PIN = 17  # driven high when an image is ready; wired to the master's RDY input
 CMD_CAPTURE   = 0x01
 CMD_PKT_REQ   = 0x02
 CMD_ACK_READY = 0x03
-PACKET_SIZE   = 150
+
+# Each 256-byte SPI frame: [u8 slave_id][u16 index][u16 total][u16 payload_len][u32 crc] + raw JPEG bytes
+# crc is the CRC-32 of the whole JPEG in the last frame and 0 in the others
+FRAME_SIZE    = 256
+PKT_HDR       = struct.Struct('<BHHHI')
+PAYLOAD_SIZE  = FRAME_SIZE - PKT_HDR.size
+MAX_FRAMES    = 255  # frame count and index travel in one byte; 0xFF is the count query
 
 # ======== Setup ========
 GPIO.setmode(GPIO.BCM)
 GPIO.setup(CS_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)  # we’ll detect CS falling
+GPIO.setup(READY_PIN, GPIO.OUT, initial=GPIO.LOW)
 
 spi = spidev.SpiDev()
 spi.open(0, 0)   # we only care about MISO, MOSI, SCLK
 spi.max_speed_hz = 1_000_000
 spi.mode = 0
 
+# One camera for the life of the process; re-initialising Picamera2 per capture costs seconds
+cam = CameraModule()
+atexit.register(cam.close)
+
 # State
-packets = []
+# Two frame pools: one is served to the master while the next capture is packetized into the other
+frame_pools = [bytearray(MAX_FRAMES * FRAME_SIZE) for _ in range(2)]
+frames = memoryview(frame_pools[0])
+total_frames = 0
+capture_requests = queue.Queue()
+captured = queue.Queue(maxsize=1)
 ready = False
+capture_seq = 0  # number of the latest CAPTURE; only its image may be published
+publish_lock = threading.Lock()  # orders a CAPTURE against an in-flight publish
+reply = bytearray(2)  # reused for every 2-byte [cmd, value] reply
 
-def wait_for_commands():
-    global packets, ready
+def build_frames(img_bytes, slave_id, out):
+    """Split the JPEG into back-to-back SPI frames written into out; returns the frame count."""
+    total = -(-len(img_bytes) // PAYLOAD_SIZE)
+    if total * FRAME_SIZE > len(out):
+        raise ValueError(f"image of {len(img_bytes)} bytes needs {total} frames, max is {len(out) // FRAME_SIZE}")
+    # One CRC over the whole image, carried by the last frame, instead of one per frame
+    crc = zlib.crc32(img_bytes)
+    img = memoryview(img_bytes)
+    for idx in range(total):
+        payload = img[idx * PAYLOAD_SIZE:(idx + 1) * PAYLOAD_SIZE]
+        offset = idx * FRAME_SIZE
+        PKT_HDR.pack_into(out, offset, slave_id, idx, total, len(payload), crc if idx == total - 1 else 0)
+        out[offset + PKT_HDR.size:offset + PKT_HDR.size + len(payload)] = payload
+    return total
+
+def send_reply(cmd, value):
+    reply[0] = cmd
+    reply[1] = value
+    spi.writebytes2(reply)
+
+def capture_worker():
+    """Stage 1: run the camera for each CAPTURE command."""
+    while True:
+        seq = capture_requests.get()
+        captured.put((seq, cam.capture_image(byte_image=True, save_to_disk=False)))
+
+def packetize_worker():
+    """Stage 2: split each captured JPEG into the back frame pool, then publish it."""
+    global frames, total_frames, ready
+    back = 1
     while True:
-        # busy‐wait for CS low
-        if GPIO.input(CS_PIN) == 0:
-            cmd, arg = spi.readbytes(2)
-            if cmd == CMD_CAPTURE:
-                # capture + packetize
-                cam = CameraModule()
-                img_bytes = cam.capture_image(byte_image=True)
-                cam.close()
-                packets = encode_image_to_packets(img_bytes, SLAVE_ID)
-                ready = True
-
-                # ack immediately so master’s next poll sees ready
-                spi.xfer2([CMD_ACK_READY, 1])
-
-            elif cmd == CMD_ACK_READY:
-                # master is just polling — reply 1 if ready else 0
-                spi.xfer2([CMD_ACK_READY, 1 if ready else 0])
-
-            elif cmd == CMD_PKT_REQ:
-                if arg == 0xFF:
-                    # query total count
-                    spi.xfer2([CMD_PKT_REQ, len(packets)])
-                else:
-                    idx = arg
-                    pkt = packets[idx]
-                    raw = json.dumps(pkt).encode('utf-8')
-                    # pad/truncate to 256 bytes
-                    buf = raw.ljust(256, b'\x00')[:256]
-                    spi.xfer2(list(buf))
-        time.sleep(0.001)
+        seq, img_bytes = captured.get()
+        if seq != capture_seq:
+            # a newer CAPTURE arrived while this one ran; its image must not answer it
+            continue
+        if img_bytes is None:
+            print("Capture failed")
+            continue
+        try:
+            count = build_frames(img_bytes, SLAVE_ID, frame_pools[back])
+        except ValueError as e:
+            print(f"Capture too large to send: {e}")
+            continue
+        with publish_lock:
+            if seq != capture_seq:
+                continue
+            frames, total_frames = memoryview(frame_pools[back]), count
+            ready = True
+            GPIO.output(READY_PIN, GPIO.HIGH)
+        back ^= 1
+
+def handle_spi_frame(channel):
+    """Runs on each falling CS edge: read the command and answer it."""
+    global ready, total_frames, capture_seq
+    cmd, arg = spi.readbytes(2)
+    if cmd == CMD_CAPTURE:
+        # hand off to the capture pipeline so this callback returns at once
+        with publish_lock:
+            capture_seq += 1
+            seq = capture_seq
+            GPIO.output(READY_PIN, GPIO.LOW)
+            # a slave that is not ready reports no frames, so the previous image is never served
+            ready = False
+            total_frames = 0
+        capture_requests.put(seq)
+
+        # ack immediately; READY goes high once the frames are built
+        send_reply(CMD_ACK_READY, 0)
+
+    elif cmd == CMD_ACK_READY:
+        # master is just polling — reply 1 if ready else 0
+        send_reply(CMD_ACK_READY, 1 if ready else 0)
+
+    elif cmd == CMD_PKT_REQ:
+        if arg == 0xFF:
+            # query total count
+            send_reply(CMD_PKT_REQ, total_frames)
+        else:
+            idx = arg
+            # writebytes2 takes the buffer directly, no per-byte int list
+            spi.writebytes2(frames[idx * FRAME_SIZE:(idx + 1) * FRAME_SIZE])
+
+def wait_for_commands():
+    threading.Thread(target=capture_worker, daemon=True).start()
+    threading.Thread(target=packetize_worker, daemon=True).start()
+    # The kernel wakes us on each CS falling edge; nothing runs between frames
+    GPIO.add_event_detect(CS_PIN, GPIO.FALLING, callback=handle_spi_frame)
+    try:
+        threading.Event().wait()
+    finally:
+        GPIO.remove_event_detect(CS_PIN)
 
 if __name__ == "__main__":
     wait_for_commands()
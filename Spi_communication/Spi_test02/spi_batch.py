@@ -0,0 +1,78 @@
+# Frames are read straight into one reusable buffer through the spidev ioctl.
+# They are not batched: the slave answers one command per CS falling edge, so
+# every frame still costs its own select, ioctl and deselect round trip.
+import ctypes
+import fcntl
+
+# ======== spidev ioctl interface (linux/spi/spidev.h) ========
+class SpiIocTransfer(ctypes.Structure):
+    _fields_ = [
+        ("tx_buf", ctypes.c_uint64),
+        ("rx_buf", ctypes.c_uint64),
+        ("len", ctypes.c_uint32),
+        ("speed_hz", ctypes.c_uint32),
+        ("delay_usecs", ctypes.c_uint16),
+        ("bits_per_word", ctypes.c_uint8),
+        ("cs_change", ctypes.c_uint8),
+        ("tx_nbits", ctypes.c_uint8),
+        ("rx_nbits", ctypes.c_uint8),
+        ("word_delay_usecs", ctypes.c_uint8),
+        ("pad", ctypes.c_uint8),
+    ]
+
+def SPI_IOC_MESSAGE(n):
+    """_IOW('k', 0, struct spi_ioc_transfer[n])"""
+    return (1 << 30) | ((n * ctypes.sizeof(SpiIocTransfer)) << 16) | (ord('k') << 8)
+
+class _TransferBuffers:
+    """rx/tx buffers and the ioctl transfer array, kept across read_frames calls."""
+    def __init__(self):
+        self.rx = self.tx = bytearray()
+        self.rx_addr = self.tx_addr = 0
+        self.xfers = (SpiIocTransfer * 0)()
+
+    def reserve(self, rx_len, tx_len, n_xfers):
+        # Buffers are replaced, never resized, so views handed out earlier stay valid
+        # The ctypes views pin each buffer while the kernel writes through its address
+        if rx_len > len(self.rx):
+            self.rx = bytearray(rx_len)
+            self._rx_view = (ctypes.c_char * rx_len).from_buffer(self.rx)
+            self.rx_addr = ctypes.addressof(self._rx_view)
+        if tx_len > len(self.tx):
+            self.tx = bytearray(tx_len)
+            self._tx_view = (ctypes.c_char * tx_len).from_buffer(self.tx)
+            self.tx_addr = ctypes.addressof(self._tx_view)
+        if n_xfers > len(self.xfers):
+            self.xfers = (SpiIocTransfer * n_xfers)()
+
+_buffers = _TransferBuffers()
+
+def read_frames(spi, cmd, count, frame_size, select, deselect):
+    """
+    Request frames 0..count-1 with [cmd, index] and read each one back.
+    The slave reads one command per CS falling edge, and the slave CS lines
+    are GPIOs that spidev's cs_change cannot toggle, so every frame gets its
+    own select()/deselect() around a single request/response ioctl.
+
+    Returns a memoryview of count * frame_size bytes. It shares a buffer
+    with later calls, so copy out what is needed before reading again.
+    """
+    bufs = _buffers
+    bufs.reserve(count * frame_size, 2 * count, 2)
+    tx, xfers = bufs.tx, bufs.xfers
+    tx[0:2 * count:2] = bytes([cmd]) * count
+    tx[1:2 * count:2] = bytes(range(count))
+    request, response = xfers[0], xfers[1]
+    request.len = 2
+    response.len = frame_size
+    message = SPI_IOC_MESSAGE(2)
+
+    for idx in range(count):
+        request.tx_buf = bufs.tx_addr + 2 * idx
+        response.rx_buf = bufs.rx_addr + idx * frame_size
+        select()
+        try:
+            fcntl.ioctl(spi.fileno(), message, xfers)
+        finally:
+            deselect()
+    return memoryview(bufs.rx)[:count * frame_size]
@@ -2,11 +2,17 @@
 #  Master Raspberry Pi control over TCP
 #==========================================
 
+import asyncio
+import atexit
 import socket
 import time
-import threading
-import json
 import os
+import struct
+import msgspec
+
+# Commands and responses travel as msgpack bodies behind a 4-byte length
+_encoder = msgspec.msgpack.Encoder()
+_decoder = msgspec.msgpack.Decoder()
 
 # Replace with your actual slave Pi hostnames
 SLAVE_HOSTS = {
@@ -20,47 +26,73 @@ SLAVE_HOSTS = {
 
 SLAVE_PORT = 8888  # Port that slaves will listen on
 TIMEOUT = 30  # Timeout in seconds
+CHUNK_SIZE = 65536  # Bytes read from a slave per image chunk
+RECV_BUFFER_SIZE = 1 << 18  # Kernel receive buffer per slave connection
+FRAME_HEADER = struct.Struct('>I')  # Big-endian length in front of every command and response
 MASTER_IMAGE_DIR = "/home/rpiez/received_images"  # Directory to save received images
 
+# Capture command encoded once per send_image value; each send patches in the
+# timestamp, which msgpack stores as a fixed-width big-endian float64
+def _capture_command_template(send_image):
+    body = _encoder.encode({"action": "capture", "timestamp": 0.0, "send_image": send_image})
+    return FRAME_HEADER.pack(len(body)) + body
+
+CAPTURE_COMMANDS = {send_image: _capture_command_template(send_image) for send_image in (True, False)}
+TIMESTAMP = struct.Struct('>d')
+TIMESTAMP_OFFSET = CAPTURE_COMMANDS[True].index(b"\xa9timestamp\xcb") + len(b"\xa9timestamp\xcb")
+
+def capture_command(send_image):
+    command = bytearray(CAPTURE_COMMANDS[bool(send_image)])
+    TIMESTAMP.pack_into(command, TIMESTAMP_OFFSET, time.time())
+    return command
+
+# One long-lived connection per slave, reused across captures. Streams are
+# bound to the loop that opened them, so every capture runs on the same loop
+CONNECTIONS = {}  # slave_id -> (StreamReader, StreamWriter)
+_loop = asyncio.new_event_loop()
+
 # Create master image directory
 os.makedirs(MASTER_IMAGE_DIR, exist_ok=True)
 
-def receive_image_from_slave(sock, slave_id, response_data):
+async def read_response(reader):
+    """Read one length-prefixed msgpack response from a slave"""
+    header = await asyncio.wait_for(reader.readexactly(FRAME_HEADER.size), TIMEOUT)
+    (size,) = FRAME_HEADER.unpack(header)
+    return _decoder.decode(await asyncio.wait_for(reader.readexactly(size), TIMEOUT))
+
+async def receive_image_from_slave(reader, slave_id, response_data):
     """Receive image file from slave"""
+    filepath = None
+    complete = False
     try:
-        # Receive file size
-        size_data = sock.recv(1024).decode().strip()
-        file_size = int(size_data)
+        # File size comes with the capture response; the image follows it
+        file_size = int(response_data['file_size'])
         print(f"[MASTER] Expecting image of {file_size} bytes from Slave {slave_id}")
         
-        # Send acknowledgement
-        sock.send("READY".encode())
+        timestamp = int(time.time())
+        filename = f"master_received_slave{slave_id}_{timestamp}.jpg"
+        filepath = os.path.join(MASTER_IMAGE_DIR, filename)
         
-        # Receive file data
-        received_data = b""
+        # Write file data to disk as it arrives instead of collecting it in memory
         bytes_received = 0
-        
-        while bytes_received < file_size:
-            chunk = sock.recv(min(4096, file_size - bytes_received))
-            if not chunk:
-                break
-            received_data += chunk
-            bytes_received += len(chunk)
-            
-            # Show progress for large files
-            if file_size > 100000:  # Show progress for files > 100KB
-                progress = (bytes_received / file_size) * 100
-                print(f"[MASTER] Receiving from Slave {slave_id}: {progress:.1f}%")
+        with open(filepath, 'wb') as f:
+            f.truncate(file_size)
+            while bytes_received < file_size:
+                try:
+                    chunk = await asyncio.wait_for(
+                        reader.readexactly(min(CHUNK_SIZE, file_size - bytes_received)), TIMEOUT)
+                except asyncio.IncompleteReadError:
+                    break
+                f.write(chunk)
+                bytes_received += len(chunk)
+                
+                # Show progress for large files
+                if file_size > 100000:  # Show progress for files > 100KB
+                    progress = (bytes_received / file_size) * 100
+                    print(f"[MASTER] Receiving from Slave {slave_id}: {progress:.1f}%")
         
         if bytes_received == file_size:
-            # Save the image
-            timestamp = int(time.time())
-            filename = f"master_received_slave{slave_id}_{timestamp}.jpg"
-            filepath = os.path.join(MASTER_IMAGE_DIR, filename)
-            
-            with open(filepath, 'wb') as f:
-                f.write(received_data)
-            
+            complete = True
             print(f"[MASTER] Image saved from Slave {slave_id}: {filename}")
             return {
                 "success": True,
@@ -75,75 +107,118 @@ def receive_image_from_slave(sock, slave_id, response_data):
     except Exception as e:
         print(f"[MASTER] Error receiving image from Slave {slave_id}: {e}")
         return {"success": False, "error": str(e)}
+    finally:
+        # The file is pre-sized to the full image, so a partial one must not be left behind
+        if not complete and filepath is not None:
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
 
-def send_capture_command(slave_host, slave_id, receive_image=True):
+async def open_slave_connection(slave_host):
+    """Open a tuned stream connection to a slave"""
+    # The receive buffer must be sized before connect to take effect on the advertised window
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+    sock.setblocking(False)
+    try:
+        await asyncio.wait_for(
+            asyncio.get_running_loop().sock_connect(sock, (slave_host, SLAVE_PORT)), TIMEOUT)
+    except BaseException:
+        sock.close()
+        raise
+    return await asyncio.open_connection(sock=sock, limit=CHUNK_SIZE)
+
+def drop_connection(slave_id):
+    """Forget a slave's pooled connection after an error"""
+    conn = CONNECTIONS.pop(slave_id, None)
+    if conn is not None:
+        conn[1].close()
+
+async def request_capture(slave_host, slave_id, command):
+    """Send a command over the slave's pooled connection and read the response"""
+    # A pooled connection may have been closed by the slave since the last
+    # capture; in that case reconnect once and resend
+    for attempt in range(2):
+        reused = slave_id in CONNECTIONS and not CONNECTIONS[slave_id][1].is_closing()
+        if not reused:
+            drop_connection(slave_id)
+            print(f"[MASTER] Connecting to Slave {slave_id} at {slave_host}:{SLAVE_PORT}...")
+            CONNECTIONS[slave_id] = await open_slave_connection(slave_host)
+            print(f"[MASTER] Connected to Slave {slave_id}")
+        reader, writer = CONNECTIONS[slave_id]
+        try:
+            writer.write(command)
+            await writer.drain()
+            print(f"[MASTER] Sent capture command to Slave {slave_id}")
+            return reader, await read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            drop_connection(slave_id)
+            if not reused or attempt:
+                raise
+
+async def capture_from_slave(slave_host, slave_id, receive_image=True):
     """Send capture command to a slave and optionally receive the image"""
     try:
-        print(f"[MASTER] Connecting to Slave {slave_id} at {slave_host}:{SLAVE_PORT}...")
-        
-        # Create socket and connect
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(TIMEOUT)
-        sock.connect((slave_host, SLAVE_PORT))
-        
-        print(f"[MASTER] Connected to Slave {slave_id}")
-        
-        # Send capture command
-        command = {
-            "action": "capture",
-            "timestamp": time.time(),
-            "send_image": receive_image
-        }
-        message = json.dumps(command) + '\n'
-        sock.send(message.encode())
-        print(f"[MASTER] Sent capture command to Slave {slave_id}")
-        
-        # Wait for response
-        response = sock.recv(1024).decode().strip()
-        response_data = json.loads(response)
-        
-        print(f"[MASTER] Response from Slave {slave_id}: {response_data['message']}")
+        # Send capture command and wait for response
+        command = capture_command(receive_image)
+        reader, response_data = await request_capture(slave_host, slave_id, command)
         
         if response_data['status'] == 'success':
             print(f"[MASTER] Slave {slave_id} successfully captured image")
             
             # Receive image if requested, and capture was successful
             if receive_image:
-                image_result = receive_image_from_slave(sock, slave_id, response_data)
+                image_result = await receive_image_from_slave(reader, slave_id, response_data)
                 if image_result['success']:
                     print(f"[MASTER] Image successfully received from Slave {slave_id}")
                 else:
+                    # The rest of the image may still be in flight; start clean next time
+                    drop_connection(slave_id)
                     print(f"[MASTER] Failed to receive image from Slave {slave_id}: {image_result.get('error')}")
         else:
             print(f"[MASTER] Slave {slave_id} failed to capture image: {response_data.get('error', 'Unknown error')}")
             
-    except socket.timeout:
+    except asyncio.TimeoutError:
+        drop_connection(slave_id)
         print(f"[MASTER] Timeout waiting for Slave {slave_id}")
     except ConnectionRefusedError:
+        drop_connection(slave_id)
         print(f"[MASTER] Could not connect to Slave {slave_id} - service not running")
     except Exception as e:
+        drop_connection(slave_id)
         print(f"[MASTER] Error communicating with Slave {slave_id}: {e}")
-    finally:
-        try:
-            sock.close()
-        except:
-            pass
+
+async def close_all_connections():
+    writers = [writer for _, writer in CONNECTIONS.values()]
+    CONNECTIONS.clear()
+    for writer in writers:
+        writer.close()
+    await asyncio.gather(*(writer.wait_closed() for writer in writers), return_exceptions=True)
+
+def close_connections():
+    """Close every pooled slave connection and the event loop"""
+    if not _loop.is_closed():
+        _loop.run_until_complete(close_all_connections())
+        _loop.close()
+
+atexit.register(close_connections)
+
+def send_capture_command(slave_host, slave_id, receive_image=True):
+    """Send capture command to a single slave"""
+    _loop.run_until_complete(capture_from_slave(slave_host, slave_id, receive_image))
+
+async def capture_from_all_slaves(receive_images=True):
+    await asyncio.gather(*(
+        capture_from_slave(slave_host, slave_id, receive_images)
+        for slave_id, slave_host in SLAVE_HOSTS.items()
+    ))
 
 def send_capture_to_all_slaves(receive_images=True):
     """Send capture command to all slaves simultaneously"""
-    threads = []
-    
-    for slave_id, slave_host in SLAVE_HOSTS.items():
-        thread = threading.Thread(
-            target=send_capture_command, 
-            args=(slave_host, slave_id, receive_images)
-        )
-        threads.append(thread)
-        thread.start()
-    
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.join()
+    # One event loop drives every slave connection; no thread per slave
+    _loop.run_until_complete(capture_from_all_slaves(receive_images))
 
 def send_capture_sequential(receive_images=True):
     """Send capture command to slaves one by one"""
@@ -2,19 +2,87 @@
 #  Slave Raspberry Pi control over TCP
 #========================================
 
+import asyncio
+import logging
 import socket
 import threading
-import json
 import time
 import os
 import signal
+import struct
+import functools
+import contextlib
+import mmap
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+import msgspec
 from camera_module_v4_3 import CameraModule
 
+
+class Command(msgspec.Struct):
+    """A command from the master; fields it does not use (e.g. timestamp) are ignored"""
+    action: Optional[str] = None
+    send_image: bool = False
+    persist: bool = False
+
+
+# Commands and responses travel as msgpack bodies behind a 4-byte length;
+# commands are decoded straight into Command, which also validates their shape
+_encoder = msgspec.msgpack.Encoder()
+_decoder = msgspec.msgpack.Decoder(Command)
+
 # Configuration - Change these for each slave
 SLAVE_ID = 1  # Change this per slave (1, 2, 3, etc.)
 HOST = '0.0.0.0'  # Listen on all interfaces
 PORT = 8888  # Port to listen on
 IMAGE_DIR = f"/home/rpiez1/images/slave{SLAVE_ID}"  # Directory to save images
+SEND_BUFFER_SIZE = 1 << 20  # Kernel send buffer per master connection; fits a whole JPEG
+FRAME_HEADER = struct.Struct('>I')  # Big-endian length in front of every command and response
+FLOAT64 = struct.Struct('>d')  # msgpack float64 payload
+IDLE_TIMEOUT = 300  # Seconds a master connection may sit without a command before it is closed
+
+# Socket options applied to every master connection and to the listener; tune them here in one place
+SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),  # small responses go out without waiting on Nagle
+    (socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE),
+    # Keep-alive probes find a master that vanished without closing (e.g. dropped off Wi-Fi)
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30),
+    (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10),
+    (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3),
+]
+
+
+def encode_frame(response):
+    """Encode a response as a length-prefixed msgpack frame"""
+    body = _encoder.encode(response)
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+@functools.lru_cache(maxsize=32)
+def unknown_command_frame(action):
+    return encode_frame({
+        "status": "error",
+        "message": f"Unknown command: {action}"
+    })
+
+
+# Sent for a body that is not valid msgpack or not a command, so the master
+# is not left waiting for a response
+INVALID_COMMAND_FRAME = encode_frame({
+    "status": "error",
+    "message": "Invalid command"
+})
+
+
+@contextlib.contextmanager
+def corked(sock):
+    """Hold small writes in the kernel so they leave coalesced with the bulk data after them"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+    try:
+        yield
+    finally:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
 
 
 class WiFiSlaveCamera:
@@ -23,177 +91,289 @@ class WiFiSlaveCamera:
         self.host = host
         self.port = port
         self.camera = CameraModule()
-        self.server_socket = None
+        # The camera cannot take two captures at once, so every blocking camera call
+        # goes through one worker thread; the event loop handles everything else
+        self.camera_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="camera")
+        # Messages carry the "[SLAVE n]" prefix through the logger name
+        self.log = logging.getLogger(f"SLAVE {slave_id}")
+        self.loop = None
         self.running = False
+        # Open client connections and the tasks serving them, closed on stop
+        self.clients = {}
+
+        # The status response has a fixed shape; it is encoded once and only the
+        # uptime, kept last so it sits at the end of the frame, is patched per request
+        self._status_frame = encode_frame({
+            "status": "success",
+            "message": f"Slave {self.slave_id} is running",
+            "slave_id": self.slave_id,
+            "uptime": 0.0
+        })
+
+        # File name and path are built once; each capture only substitutes its timestamp
+        self._name_tpl = f"slave{slave_id}_image_%d.jpg"
+        self._path_tpl = os.path.join(IMAGE_DIR, self._name_tpl)
 
         # Create image directory if it doesn't exist
         os.makedirs(IMAGE_DIR, exist_ok=True)
-        print(f"[SLAVE {self.slave_id}] Image directory: {IMAGE_DIR}")
-
-    def capture_image(self):
-        """Capture an image using the camera module"""
-        try:
-            timestamp = int(time.time())
-            filename = f"slave{self.slave_id}_image_{timestamp}.jpg"
-            filepath = os.path.join(IMAGE_DIR, filename)
+        self.log.info("Image directory: %s", IMAGE_DIR)
 
-            print(f"[SLAVE {self.slave_id}] Capturing image: {filename}")
-            self.camera.capture_image(filename=filepath)
+    def capture_image(self, save_to_disk=True):
+        """Capture an image using the camera module
 
-            return {
+        Returns the response dict and the JPEG bytes (None on failure).
+        """
+        try:
+            timestamp = time.time_ns() // 1_000_000_000
+            filename = self._name_tpl % timestamp
+            filepath = self._path_tpl % timestamp
+
+            self.log.info("Capturing image: %s", filename)
+            image_bytes = self.camera.capture_image(filename=filepath, save_to_disk=save_to_disk)
+            if image_bytes is None:
+                raise RuntimeError("camera returned no image")
+
+            # The master only needs the outcome and the name; the local path is
+            # rebuilt from the timestamp when the saved file is sent
+            result = {
                 "status": "success",
-                "message": f"Slave {self.slave_id} image captured successfully",
-                "filename": filename,
-                "filepath": filepath,
                 "timestamp": timestamp
             }
+            if save_to_disk:
+                result["filename"] = filename
+            return result, image_bytes
         except Exception as e:
             error_msg = f"Failed to capture image: {str(e)}"
-            print(f"[SLAVE {self.slave_id}] {error_msg}")
+            self.log.error("%s", error_msg)
             return {
                 "status": "error",
                 "message": f"Slave {self.slave_id} image capture failed",
                 "error": error_msg
-            }
+            }, None
 
-    def send_image_to_client(self, client_socket, filepath):
-        """Send image file to client"""
+    async def send_image_to_client(self, writer, image_bytes):
+        """Send in-memory image bytes to client right after the capture response"""
         try:
-            with open(filepath, 'rb') as f:
-                file_data = f.read()
-
-            file_size = len(file_data)
-            client_socket.send(f"{file_size}\n".encode())
-
-            ack = client_socket.recv(1024).decode().strip()
-            if ack == "READY":
-                client_socket.sendall(file_data)
-                print(f"[SLAVE {self.slave_id}] Image sent successfully ({file_size} bytes)")
-                return True
-            else:
-                print(f"[SLAVE {self.slave_id}] Client not ready to receive image")
-                return False
+            writer.write(image_bytes)
+            await writer.drain()
+            self.log.info("Image sent successfully (%d bytes)", len(image_bytes))
+            return True
 
         except Exception as e:
-            print(f"[SLAVE {self.slave_id}] Error sending image: {e}")
+            self.log.error("Error sending image: %s", e)
             return False
 
-    def handle_client(self, client_socket, client_address):
-        """Handle incoming client connection"""
+    async def send_image_file_to_client(self, writer, image_file, file_size):
+        """Send an open image file to client right after the capture response"""
         try:
-            print(f"[SLAVE {self.slave_id}] Client connected from {client_address}")
-
-            data = client_socket.recv(1024).decode().strip()
-            if not data:
-                return
+            try:
+                # sendfile(2) copies file -> socket inside the kernel, no Python-side buffer
+                sent = await self.loop.sendfile(writer.transport, image_file, 0, file_size, fallback=False)
+            except asyncio.SendfileNotAvailableError:
+                sent = await self.send_mapped_file(writer, image_file, file_size)
+            self.log.info("Image sent successfully (%d bytes)", sent)
+            return True
 
-            command = json.loads(data)
-            print(f"[SLAVE {self.slave_id}] Received command: {command}")
-
-            if command.get('action') == 'capture':
-                result = self.capture_image()
-
-                response = json.dumps(result) + '\n'
-                client_socket.send(response.encode())
-                print(f"[SLAVE {self.slave_id}] Sent response to master")
+        except Exception as e:
+            self.log.error("Error sending image: %s", e)
+            return False
 
-                if result['status'] == 'success' and command.get('send_image', False):
-                    print(f"[SLAVE {self.slave_id}] Preparing to send image...")
-                    self.send_image_to_client(client_socket, result['filepath'])
+    async def send_mapped_file(self, writer, image_file, file_size):
+        """Send a file through an mmap for transports without sendfile"""
+        try:
+            image_map = mmap.mmap(image_file.fileno(), file_size, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty or unmappable file: read it into memory instead
+            writer.write(image_file.read(file_size))
+            await writer.drain()
+            return file_size
+
+        transport = writer.transport
+        limits = transport.get_write_buffer_limits()
+        # The transport may keep slices of the view queued after a normal drain;
+        # with no low-water mark drain only returns once every byte has left,
+        # so the mapping is never closed while the transport still reads it
+        transport.set_write_buffer_limits(high=0)
+        try:
+            with image_map, memoryview(image_map) as view:
+                writer.write(view)
+                await writer.drain()
+        finally:
+            transport.set_write_buffer_limits(high=limits[1], low=limits[0])
+        return file_size
+
+    def send_response(self, writer, response):
+        """Queue a msgpack response framed by its length"""
+        writer.write(encode_frame(response))
+
+    async def handle_client(self, reader, writer):
+        """Handle incoming client connection until the client disconnects"""
+        client_address = writer.get_extra_info('peername')
+        client_socket = writer.get_extra_info('socket')
+        for level, option, value in SOCKET_OPTIONS:
+            client_socket.setsockopt(level, option, value)
+        self.clients[writer] = asyncio.current_task()
+        try:
+            self.log.info("Client connected from %s", client_address)
 
-            elif command.get('action') == 'status':
-                status = {
-                    "status": "success",
-                    "message": f"Slave {self.slave_id} is running",
-                    "slave_id": self.slave_id,
-                    "uptime": time.time() - self.start_time
-                }
-                response = json.dumps(status) + '\n'
-                client_socket.send(response.encode())
+            # Masters may keep the connection open and send one framed command after
+            # another; it is served until the master closes it or goes idle
+            while True:
+                try:
+                    header = await asyncio.wait_for(reader.readexactly(FRAME_HEADER.size), IDLE_TIMEOUT)
+                    (size,) = FRAME_HEADER.unpack(header)
+                    body = await reader.readexactly(size)
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.TimeoutError:
+                    self.log.info("Closing idle connection from %s", client_address)
+                    break
+                try:
+                    command = _decoder.decode(body)
+                except msgspec.DecodeError:
+                    self.log.warning("Invalid command received from %s", client_address)
+                    writer.write(INVALID_COMMAND_FRAME)
+                    await writer.drain()
+                    continue
+                await self.handle_command(writer, command)
 
-            else:
-                error_response = {
-                    "status": "error",
-                    "message": f"Unknown command: {command.get('action', 'None')}"
-                }
-                response = json.dumps(error_response) + '\n'
-                client_socket.send(response.encode())
-
-        except json.JSONDecodeError:
-            print(f"[SLAVE {self.slave_id}] Invalid JSON received from {client_address}")
         except Exception as e:
-            print(f"[SLAVE {self.slave_id}] Error handling client {client_address}: {e}")
+            self.log.error("Error handling client %s: %s", client_address, e)
         finally:
-            client_socket.close()
+            self.clients.pop(writer, None)
+            writer.close()
+
+    async def handle_command(self, writer, command):
+        """Run a single command and send its response"""
+        self.log.debug("Received command: %s", command)
+        client_socket = writer.get_extra_info('socket')
+
+        if command.action == 'capture':
+            send_image = command.send_image
+            # An image only wanted by the master skips the SD card unless the
+            # command asks for it to be kept
+            in_memory = send_image and not command.persist
+            # The camera call blocks, so it runs off the event loop; captures
+            # requested by several masters queue up on the camera worker
+            result, image_bytes = await self.loop.run_in_executor(
+                self.camera_executor, self.capture_image, not in_memory)
+            send_image = send_image and result['status'] == 'success'
+
+            # The image follows the response directly; its size is part of
+            # the response so the master needs no extra handshake. The socket is
+            # corked so the small response leaves coalesced with the image
+            if not send_image:
+                self.send_response(writer, result)
+                self.log.info("Sent response to master")
+            elif in_memory:
+                result['file_size'] = len(image_bytes)
+                with corked(client_socket):
+                    self.send_response(writer, result)
+                    self.log.info("Sent response to master")
+
+                    self.log.info("Preparing to send image...")
+                    await self.send_image_to_client(writer, image_bytes)
+            else:
+                # One open file gives both the advertised size and the bytes sent;
+                # O_NOATIME spares the SD card an inode update for every image read
+                fd = os.open(self._path_tpl % result['timestamp'], os.O_RDONLY | os.O_NOATIME)
+                with open(fd, 'rb') as image_file:
+                    result['file_size'] = os.fstat(fd).st_size
+                    with corked(client_socket):
+                        self.send_response(writer, result)
+                        self.log.info("Sent response to master")
+
+                        self.log.info("Preparing to send image...")
+                        await self.send_image_file_to_client(writer, image_file, result['file_size'])
+                    # The image is kept on the card but not needed again; let its pages
+                    # go so a run of captures does not push out more useful cache
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+        elif command.action == 'status':
+            status = bytearray(self._status_frame)
+            uptime = (time.monotonic_ns() - self.start_time_ns) / 1e9
+            FLOAT64.pack_into(status, len(status) - FLOAT64.size, uptime)
+            writer.write(status)
+
+        else:
+            writer.write(unknown_command_frame(str(command.action)))
+
+        await writer.drain()
+
+    async def serve(self):
+        """Accept masters and serve all of their commands on one event loop"""
+        self.loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        # SO_REUSEPORT lets a restarted slave bind at once even while old sockets linger
+        server = await asyncio.start_server(
+            self.handle_client, self.host, self.port, reuse_address=True, reuse_port=True, backlog=32)
+        # Set on the listener too so accepted sockets inherit them where supported
+        for listener in server.sockets:
+            for level, option, value in SOCKET_OPTIONS:
+                listener.setsockopt(level, option, value)
+
+        # Signals stop the server from inside the loop, so shutdown always runs
+        # through the same path; they can only be installed from the main thread
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self.loop.add_signal_handler(signum, self.on_signal)
+
+        self.running = True
+        self.start_time_ns = time.monotonic_ns()  # uptime is unaffected by wall-clock changes
+
+        self.log.info("WiFi Camera Server started on %s:%s", self.host, self.port)
+        self.log.info("Waiting for connections...")
+
+        async with server:
+            await self._stop.wait()
+            # Closing the clients ends their handlers, so the server can finish closing
+            handlers = list(self.clients.values())
+            for writer in list(self.clients):
+                writer.close()
+            await asyncio.gather(*handlers, return_exceptions=True)
 
     def start_server(self):
         """Start the WiFi server"""
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
-
-            self.running = True
-            self.start_time = time.time()
-
-            print(f"[SLAVE {self.slave_id}] WiFi Camera Server started on {self.host}:{self.port}")
-            print(f"[SLAVE {self.slave_id}] Waiting for connections...")
-
-            while self.running:
-                try:
-                    client_socket, client_address = self.server_socket.accept()
-                    client_thread = threading.Thread(
-                        target=self.handle_client,
-                        args=(client_socket, client_address)
-                    )
-                    client_thread.daemon = True
-                    client_thread.start()
-
-                except socket.error as e:
-                    if self.running:
-                        print(f"[SLAVE {self.slave_id}] Socket error: {e}")
-
+            asyncio.run(self.serve())
         except Exception as e:
-            print(f"[SLAVE {self.slave_id}] Server error: {e}")
+            self.log.error("Server error: %s", e)
         finally:
             self.cleanup()
 
+    def on_signal(self):
+        """Handle interrupt signals"""
+        self.log.info("Interrupt received, shutting down...")
+        self.running = False
+        self._stop.set()
+
     def stop_server(self):
-        """Stop the WiFi server"""
-        print(f"[SLAVE {self.slave_id}] Stopping server...")
+        """Stop the WiFi server; safe to call from any thread"""
+        self.log.info("Stopping server...")
         self.running = False
-        if self.server_socket:
-            self.server_socket.close()
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._stop.set)
+            except RuntimeError:
+                pass  # loop already closed
 
     def cleanup(self):
         """Clean up resources"""
-        if self.server_socket:
-            self.server_socket.close()
-        print(f"[SLAVE {self.slave_id}] Server stopped")
-
-
-def signal_handler(signum, frame):
-    """Handle interrupt signals"""
-    print(f"\n[SLAVE {SLAVE_ID}] Interrupt received, shutting down...")
-    if 'slave_camera' in globals():
-        slave_camera.stop_server()
-    exit(0)
+        self.camera_executor.shutdown(wait=True)
+        # The pipeline runs for the life of the server; stop it and release the
+        # device only once no capture can still be using it
+        self.camera.close()
+        self.log.info("Server stopped")
 
 
 if __name__ == "__main__":
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-
-    print(f"[SLAVE {SLAVE_ID}] WiFi Slave Camera Starting...")
-    print(f"[SLAVE {SLAVE_ID}] Slave ID: {SLAVE_ID}")
-    print(f"[SLAVE {SLAVE_ID}] Listening on: {HOST}:{PORT}")
+    logging.basicConfig(level=logging.INFO, format="[%(name)s] %(message)s")
+    log = logging.getLogger(f"SLAVE {SLAVE_ID}")
+    log.info("WiFi Slave Camera Starting...")
+    log.info("Slave ID: %s", SLAVE_ID)
+    log.info("Listening on: %s:%s", HOST, PORT)
 
     slave_camera = WiFiSlaveCamera(SLAVE_ID, HOST, PORT)
 
-    try:
-        slave_camera.start_server()
-    except KeyboardInterrupt:
-        print(f"\n[SLAVE {SLAVE_ID}] Keyboard interrupt received")
-    finally:
-        slave_camera.stop_server()
+    # Runs until SIGINT or SIGTERM
+    slave_camera.start_server()